@@ -0,0 +1,74 @@
+"""
+Measures how many cache operations per second the memory tier of
+the request cache handles with different numbers of threads.
+
+Run it from the root of the repository:
+
+    $ python bench/cache_bench.py
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ffn_bot.cache import RequestCache
+
+
+def worker(cache, keys, operations, barrier):
+    rnd = random.Random()
+    barrier.wait()
+    for _ in range(operations):
+        key = rnd.choice(keys)
+        if rnd.random() < 0.2:
+            cache.push_cache("story", key, key)
+        else:
+            try:
+                cache.hit_cache("story", key)
+            except KeyError:
+                pass
+
+
+def run(shards, threads, operations, keys):
+    """Returns the operations per second of all threads together."""
+    cache = RequestCache(shards=shards)
+    for key in keys:
+        cache.push_cache("story", key, key)
+
+    barrier = threading.Barrier(threads + 1)
+    workers = [
+        threading.Thread(
+            target=worker, args=(cache, keys, operations, barrier))
+        for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--operations", type=int, default=50000,
+                        help="operations per thread")
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 16])
+    args = parser.parse_args()
+
+    keys = ["%d" % i for i in range(args.keys)]
+    print("%8s %8s %12s" % ("shards", "threads", "ops/s"))
+    for shards in args.shards:
+        for threads in args.threads:
+            ops = run(shards, threads, args.operations, keys)
+            print("%8d %8d %12d" % (shards, threads, ops))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares the lxml parser of the Google result pages with the
+BeautifulSoup parser it replaced, on the saved pages in bench/pages.
+
+Run it from the root of the repository:
+
+    $ python bench/google_bench.py
+
+BeautifulSoup is not needed by the bot. Without it only the lxml
+parser is measured.
+"""
+import os
+import sys
+import glob
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import google
+from lxml import html as lxml_html
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+PAGES = os.path.join(os.path.dirname(__file__), "pages", "google_*.html")
+
+
+def parse_lxml(html):
+    """Returns the result links like google.search does."""
+    tree = lxml_html.fromstring(html)
+    if not google.xpath_has_results(tree):
+        raise IOError("No result page")
+    links = []
+    for a in google.xpath_anchors(tree):
+        link = google.filter_result(a.get('href') or "")
+        if link:
+            links.append(link)
+    return links, google.xpath_has_nav(tree)
+
+
+def parse_bs4(html):
+    """Returns the result links like the BeautifulSoup version did."""
+    soup = BeautifulSoup(html, "lxml")
+    search = soup.find(id='search')
+    links = []
+    for a in (search.find_all('a') if search is not None else ()):
+        link = google.filter_result(a.get('href') or "")
+        if link:
+            links.append(link)
+    return links, soup.find(id='nav') is not None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200,
+                        help="parses per page and parser")
+    args = parser.parse_args()
+
+    parsers = [("lxml", parse_lxml)]
+    if BeautifulSoup is not None:
+        parsers.append(("bs4", parse_bs4))
+
+    print("%-22s %-6s %8s %10s" % ("page", "parser", "links", "us/page"))
+    for filename in sorted(glob.glob(PAGES)):
+        with open(filename, "rb") as f:
+            html = f.read()
+        results = []
+        for name, parse in parsers:
+            links, _ = parse(html)
+            results.append(links)
+            seconds = timeit.timeit(
+                lambda: parse(html), number=args.number) / args.number
+            print("%-22s %-6s %8d %10d" % (
+                os.path.basename(filename), name, len(links), seconds * 1e6))
+        if len(results) > 1 and results[0] != results[1]:
+            print("The parsers found different links!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures how fast the story pages in bench/pages are parsed.
+
+The site of a page is the part of its name before the first "_" or
+".", so "ffn_long.html" is parsed as a fanfiction.net page.
+Run it from the root of the repository:
+
+    $ python bench/parse_bench.py
+"""
+import os
+import sys
+import glob
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ffn_bot.cache import default_cache
+from ffn_bot.fetchers import ffn, ao3, ffa, aff
+
+PAGES = os.path.join(os.path.dirname(__file__), "pages")
+
+# Creates a story of each site. The link is never loaded.
+STORIES = {
+    "ffn": lambda: ffn.FanfictionNetSite().generate_response(
+        "https://www.fanfiction.net/s/123/1/", set()),
+    "ao3": lambda: ao3.Story("https://archiveofourown.org/works/42/"),
+    "ffa": lambda: ffa.Story(
+        "http://www.hpfanficarchive.com/stories/viewstory.php?sid=77"),
+    "aff": lambda: aff.Story(set(), "hp", "5"),
+}
+
+
+def site_of(filename):
+    name = os.path.basename(filename)
+    return name.split(".", 1)[0].split("_", 1)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=500,
+                        help="parses per page")
+    parser.add_argument("sites", nargs="*", default=sorted(STORIES))
+    args = parser.parse_args()
+
+    print("%-22s %10s %10s" % ("page", "bytes", "us/page"))
+    for filename in sorted(glob.glob(os.path.join(PAGES, "*.html"))):
+        site = site_of(filename)
+        if site not in args.sites or site not in STORIES:
+            continue
+        with open(filename, encoding="utf-8") as f:
+            page = f.read()
+        default_cache.get_page = lambda *args, **kwargs: page
+
+        story = STORIES[site]()
+        story.parse_html()
+        seconds = timeit.timeit(
+            story.parse_html, number=args.number) / args.number
+        print("%-22s %10d %10d" % (
+            os.path.basename(filename), len(page), seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
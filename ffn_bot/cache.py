@@ -1,88 +1,768 @@
+import os
+import sys
 import time
-import random
-from google import search
-from requests import get
-from collections import OrderedDict
+import zlib
+import pickle
+import sqlite3
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict, Counter
+
+from ffn_bot import bot_tools
+from ffn_bot.network import SessionPool, RateLimiter, CircuitBreakers
+from ffn_bot.network import ServerError, TRANSIENT_ERRORS
+from ffn_bot.network import read_until, retry, get_retry_after
+from ffn_bot.searchqueue import normalize_query
+from ffn_bot.searchproviders import HedgedSearch, IndexProvider
+from ffn_bot.searchproviders import GoogleProvider
+
+
+def entry_size(entry):
+    """Approximates the number of bytes a cache entry occupies."""
+    return _sizeof(entry[0])
+
+
+def _sizeof(data):
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(_sizeof(k) + _sizeof(v) for k, v in data.items())
+    if isinstance(data, (tuple, list)):
+        return sum(_sizeof(item) for item in data)
+    return sys.getsizeof(data)
+
+
+# Maps the response headers we keep to the request headers
+# that are used to revalidate the page.
+REVALIDATION_HEADERS = (
+    ("ETag", "If-None-Match"),
+    ("Last-Modified", "If-Modified-Since"),
+)
+
+
+def compress_page(page, validators=None):
+    """
+    Compresses a page body before it is stored.
+
+    The entry also keeps the headers needed to revalidate the page.
+    """
+    return zlib.compress(page.encode("utf-8")), validators or {}
+
+
+def _split_page(data):
+    # Entries written before validators were kept.
+    if isinstance(data, bytes):
+        return data, {}
+    return data
+
+
+def decompress_page(data):
+    """Restores the page body from a stored entry."""
+    return zlib.decompress(_split_page(data)[0]).decode("utf-8")
+
+
+def get_validators(response):
+    """Returns the request headers to revalidate the response."""
+    return dict(
+        (request_header, response.headers[response_header])
+        for response_header, request_header in REVALIDATION_HEADERS
+        if response_header in response.headers
+    )
 
 
 class LimitedSizeDict(OrderedDict):
 
-    """The actual cache implementation."""
+    """
+    The actual cache implementation.
+
+    Evicts the least recently used entries as soon as either
+    the number of entries or the number of stored bytes exceeds
+    its limit.
+    """
 
     def __init__(self, *args, **kwds):
         self.size_limit = kwds.pop("size_limit", None)
+        self.byte_limit = kwds.pop("byte_limit", None)
+        self.sizeof = kwds.pop("sizeof", entry_size)
+        self.bytes = 0
+        self.evictions = 0
         OrderedDict.__init__(self, *args, **kwds)
         self._check_size_limit()
 
     def __setitem__(self, key, value):
+        if key in self:
+            self.bytes -= self.sizeof(OrderedDict.__getitem__(self, key))
         OrderedDict.__setitem__(self, key, value)
+        self.bytes += self.sizeof(value)
         self._check_size_limit()
 
+    def __delitem__(self, key):
+        self.bytes -= self.sizeof(OrderedDict.__getitem__(self, key))
+        OrderedDict.__delitem__(self, key)
+
+    def popitem(self, last=True):
+        key, value = OrderedDict.popitem(self, last)
+        self.bytes -= self.sizeof(value)
+        return key, value
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.bytes = 0
+
     def _check_size_limit(self):
         if self.size_limit is not None:
             while len(self) > self.size_limit:
                 self.popitem(last=False)
+                self.evictions += 1
+        if self.byte_limit is not None:
+            while len(self) and self.bytes > self.byte_limit:
+                self.popitem(last=False)
+                self.evictions += 1
+
+
+class ShardedCache(object):
+
+    """
+    Memory tier that is split into shards by the hash of the key.
+
+    Every shard is a LimitedSizeDict with its own lock, so threads
+    working on different keys rarely wait for each other.
+    The limits are divided evenly between the shards.
+    """
+
+    def __init__(self, shards=16, size_limit=None, byte_limit=None):
+        self.shards = [
+            LimitedSizeDict(
+                size_limit=self._split(size_limit, shards),
+                byte_limit=self._split(byte_limit, shards))
+            for _ in range(shards)
+        ]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    @staticmethod
+    def _split(limit, shards):
+        if limit is None:
+            return None
+        return max(1, limit // shards)
+
+    def _shard(self, key):
+        index = hash(key) % len(self.shards)
+        return self.shards[index], self.locks[index]
+
+    def resize(self, byte_limit):
+        """Changes the byte budget of all shards."""
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.byte_limit = self._split(byte_limit, len(self.shards))
+                shard._check_size_limit()
+
+    def get(self, key, default=None):
+        """Returns the value and marks it as recently used."""
+        shard, lock = self._shard(key)
+        with lock:
+            try:
+                value = shard[key]
+            except KeyError:
+                return default
+            shard.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        shard, lock = self._shard(key)
+        with lock:
+            if key in shard:
+                del shard[key]
+            shard[key] = value
+
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            del shard[key]
+
+    def __contains__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return key in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def keys(self):
+        """Returns a list of all keys."""
+        result = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                result.extend(shard.keys())
+        return result
+
+    def items(self):
+        """Returns a list of all (key, value)-pairs."""
+        result = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                result.extend(shard.items())
+        return result
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self.shards)
+
+
+class PageNotFound(IOError):
+    """Raised when a page does not exist."""
+    pass
+
+
+class BadResponse(IOError):
+    """Raised when the server answers with a status we cannot use."""
+    pass
+
+
+class SQLiteStorage(object):
+
+    """
+    Persistent storage backend for the request cache.
+
+    Every entry is pickled into a single table so the cache
+    survives restarts of the bot.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "  id TEXT PRIMARY KEY,"
+                "  data BLOB NOT NULL,"
+                "  time REAL NOT NULL"
+                ")")
+
+    def get(self, cache_id):
+        """Returns the (data, time)-tuple. Raises KeyError if not stored."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data, time FROM cache WHERE id=?", (cache_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(cache_id)
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, cache_id, data, t):
+        """Stores the data."""
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (id, data, time) "
+                "VALUES (?, ?, ?)", (cache_id, blob, t))
+
+    def delete(self, cache_id):
+        """Removes the entry from the storage."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM cache WHERE id=?", (cache_id,))
+
+    def prune(self, prefix, before):
+        """
+        Removes all entries whose id starts with the prefix and
+        that were stored before the given time.
+
+        :returns: The number of removed entries.
+        """
+        with self.lock, self.db:
+            return self.db.execute(
+                "DELETE FROM cache WHERE substr(id, 1, ?)=? AND time<?",
+                (len(prefix), prefix, before)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 
 class RequestCache(object):
 
     """
     Cache for search requests and page-loads.
+
+    The cache keeps a hot in-memory LRU tier that is limited by the
+    number of bytes it stores. Page bodies are stored compressed.
+    If a storage backend is given, all entries are also written to
+    it and entries missing in memory will be looked up there.
+    Entries that expired long ago are removed from the backend.
+
+    If `stale_while_revalidate` is set, expired pages are returned
+    immediately and refreshed in the background.
+
+    Failed searches, missing pages and unparsable stories are
+    remembered as negative entries with their own expiry time.
+
+    Expired pages are revalidated using their ETag and Last-Modified
+    headers, so unchanged pages are not downloaded again.
+
+    Pages are loaded through a pool of keep-alive sessions, one for
+    every host. All requests that miss the cache go through a rate
+    limiter that is configured per site. Transient errors are retried
+    and sites that keep failing are not contacted for a while.
+
+    Concurrent misses for the same page or search are coalesced so
+    only one request is sent. The memory tier is sharded so it can
+    be used by many threads at once.
+
+    Searches are answered by the first of the search providers that
+    finds the story.
     """
 
     # Marker for non cached objects.
     EMPTY_RESULT = []
 
-    def __init__(self, max_size=10000, expire_time=30 * 60 * 1000):
-        self.cache = LimitedSizeDict(size_limit=max_size)
-        self.expire_time = expire_time
+    # Seconds until the entries of each kind expire.
+    EXPIRE_TIMES = {
+        "search": 14 * 24 * 60 * 60,
+        "get": 6 * 60 * 60,
+        "story": 6 * 60 * 60,
+        "search-miss": 60 * 60,
+        "get-miss": 60 * 60,
+        "story-miss": 60 * 60,
+    }
+
+    # Expired entries stay in the storage backend this long, so they
+    # can still be revalidated or served stale.
+    KEEP_EXPIRED = 24 * 60 * 60
+
+    # Seconds between two prunes of the storage backend.
+    PRUNE_INTERVAL = 60 * 60
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, expire_times=None,
+                 storage=None, max_size=None, stale_while_revalidate=False,
+                 shards=16, sessions=None, limiter=None, breakers=None,
+                 providers=None):
+        self.cache = ShardedCache(
+            shards, size_limit=max_size, byte_limit=max_bytes)
+        # Guards the bookkeeping, not the cached entries.
+        self.lock = threading.Lock()
+        self.expire_times = dict(self.EXPIRE_TIMES)
+        if expire_times is not None:
+            self.expire_times.update(expire_times)
+        self.storage = storage
+        self.sessions = SessionPool() if sessions is None else sessions
+        if limiter is None:
+            limiter = RateLimiter()
+            limiter.configure_host("google.com", rate=1 / 5)
+        self.limiter = limiter
+        self.breakers = CircuitBreakers() if breakers is None else breakers
+        if providers is None:
+            providers = HedgedSearch([IndexProvider(), GoogleProvider()])
+        self.providers = providers
+        self.stale_while_revalidate = stale_while_revalidate
+        self._revalidating = set()
+        self._inflight = {}
+        self._last_prune = 0
+
+        # Remembers the age of the pages a thread loaded.
+        self._local = threading.local()
+
+        # Counts hits, misses and stale hits per entry kind.
+        # The hits of the "-miss" kinds count how often a negative
+        # entry saved us a fetch.
+        self.counters = Counter()
+
+    def resize(self, max_bytes):
+        """Changes the byte budget of the memory tier."""
+        self.cache.resize(max_bytes)
+
+    def _count(self, event, type):
+        with self.lock:
+            self.counters[(event, type)] += 1
+
+    def get_statistics(self):
+        """
+        Returns a dictionary with the statistics of the cache.
+
+        Note that lookups serving a stale page count both as a miss
+        and as a stale hit.
+        """
+        entries = Counter(key.split(":", 1)[0] for key in self.cache.keys())
+        with self.lock:
+            counters = self.counters.copy()
+
+        kinds = {}
+        for type in sorted(set(self.expire_times) | set(entries)):
+            kinds[type] = {
+                "hits": counters[("hits", type)],
+                "misses": counters[("misses", type)],
+                "stale_hits": counters[("stale_hits", type)],
+                "revalidations": counters[("revalidations", type)],
+                "entries": entries[type],
+            }
+
+        return {
+            "hits": sum(kind["hits"] for kind in kinds.values()),
+            "misses": sum(kind["misses"] for kind in kinds.values()),
+            "stale_hits": sum(kind["stale_hits"] for kind in kinds.values()),
+            "evictions": self.cache.evictions,
+            "entries": len(self.cache),
+            "bytes": self.cache.bytes,
+            "kinds": kinds,
+        }
+
+    def dump(self, filename):
+        """
+        Writes all entries of the memory tier into a snapshot file.
+
+        The entries keep their timestamps so they still expire
+        after being loaded again.
+        """
+        # Oldest entries first, so loading the snapshot restores
+        # the LRU order.
+        entries = sorted(
+            ((cache_id, data, t) for cache_id, (data, t) in self.cache.items()),
+            key=lambda entry: entry[2])
+        blob = zlib.compress(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL))
+
+        # Do not destroy the last snapshot if we crash while writing.
+        with open(filename + ".tmp", "wb") as f:
+            f.write(blob)
+        os.replace(filename + ".tmp", filename)
+        return len(entries)
+
+    def load(self, filename):
+        """Loads the entries of a snapshot file into the memory tier."""
+        with open(filename, "rb") as f:
+            entries = pickle.loads(zlib.decompress(f.read()))
+        for cache_id, data, t in entries:
+            self.cache[cache_id] = (data, t)
+        return len(entries)
+
+    def prune(self):
+        """
+        Removes the entries from the storage backend that expired
+        more than KEEP_EXPIRED seconds ago.
+
+        :returns: The number of removed entries.
+        """
+        with self.lock:
+            self._last_prune = time.time()
+        if self.storage is None:
+            return 0
 
-    def hit_cache(self, type, query):
-        """Check if the value is in the cache."""
+        now = time.time()
+        return sum(
+            self.storage.prune(type + ":", now - expire - self.KEEP_EXPIRED)
+            for type, expire in self.expire_times.items())
 
-        result = self.cache.get("%s:%s" % (type, query), self.EMPTY_RESULT)
+    def _maybe_prune(self):
+        with self.lock:
+            if time.time() - self._last_prune < self.PRUNE_INTERVAL:
+                return
+            self._last_prune = time.time()
+        try:
+            self.prune()
+        except Exception:
+            bot_tools.print_exception()
+
+    def _lookup(self, cache_id):
+        """Find the entry in the memory tier or the storage backend."""
+        result = self.cache.get(cache_id, self.EMPTY_RESULT)
+        if result is not self.EMPTY_RESULT:
+            return result
+
+        if self.storage is not None:
+            try:
+                result = self.storage.get(cache_id)
+            except KeyError:
+                pass
+            else:
+                type = cache_id.split(":", 1)[0]
+                max_age = self.expire_times.get(type, 0) + self.KEEP_EXPIRED
+                if time.time() - result[1] > max_age:
+                    # Too old to be of any use.
+                    self.storage.delete(cache_id)
+                    return self.EMPTY_RESULT
+
+                # Promote the entry into the memory tier.
+                self.cache[cache_id] = result
+                return result
+
+        return self.EMPTY_RESULT
+
+    def hit_cache(self, type, query, stale=False):
+        """
+        Check if the value is in the cache.
+
+        :param stale:  Also return expired values.
+        """
+        return self._hit(type, query, stale)[0]
+
+    def _hit(self, type, query, stale=False):
+        """Like hit_cache, but returns the (value, time)-tuple."""
+        cache_id = "%s:%s" % (type, query)
+        result = self._lookup(cache_id)
         if result is not self.EMPTY_RESULT:
             # Let values expire.
-            if time.time() - result[1] <= self.expire_time:
-                self.push_cache(type, query, result[0], result[1])
+            if time.time() - result[1] <= self.expire_times[type]:
+                self._count("hits", type)
+                return result
+            if stale:
+                self._count("stale_hits", type)
+                return result
+        if not stale:
+            self._count("misses", type)
+        raise KeyError("Not cached")
+
+    def _recheck(self, type, query):
+        """
+        Like hit_cache, but without touching the statistics.
+        Used to check if a value arrived while we were waiting.
+        """
+        result = self._lookup("%s:%s" % (type, query))
+        if result is not self.EMPTY_RESULT:
+            if time.time() - result[1] <= self.expire_times[type]:
                 return result[0]
         raise KeyError("Not cached")
 
     def push_cache(self, type, query, data, t=None):
         """Push a value into the cache."""
         cache_id = "%s:%s" % (type, query)
-        if cache_id in self.cache:
-            del self.cache[cache_id]
         if t is None:
             t = time.time()
         self.cache[cache_id] = (data, t)
+        if self.storage is not None:
+            self.storage.set(cache_id, data, t)
+            self._maybe_prune()
+
+    def hit_miss(self, type, query):
+        """
+        Check if the request is known to fail.
+
+        Only hits are counted. The lookup that led here has already
+        counted its miss.
+        """
+        try:
+            self._recheck(type + "-miss", query)
+        except KeyError:
+            return False
+        self._count("hits", type + "-miss")
+        return True
 
-    def get_page(self, page, throttle=0, **kwargs):
+    def push_miss(self, type, query):
+        """Remember that the request failed."""
+        self.push_cache(type + "-miss", query, None)
+
+    def _coalesce(self, key, func, *args, **kwargs):
+        """
+        Runs the function unless a call for the same key is already
+        running. In that case wait for its result instead.
+        """
+        with self.lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self._inflight[key]
+
+    def track_pages(self):
+        """
+        Starts tracking the pages loaded by this thread.
+
+        page_time() returns when the oldest of them was fetched.
+        """
+        self._local.page_time = float("inf")
+
+    def page_time(self):
+        """
+        Stops tracking the pages of this thread.
+
+        :returns: The time the oldest tracked page was fetched
+                  or None if no page was loaded.
+        """
+        t = getattr(self._local, "page_time", None)
+        self._local.page_time = None
+        if t is None or t == float("inf"):
+            return None
+        return t
+
+    def _track_page(self, t):
+        current = getattr(self._local, "page_time", None)
+        if current is not None:
+            self._local.page_time = min(current, t)
+
+    def get_page(self, page, stop_marker=None, **kwargs):
+        """
+        Loads the page.
+
+        :param stop_marker:  A compiled regular expression for bytes.
+                             If given, the download stops as soon as
+                             the marker has been read. The truncated
+                             page is cached.
+        """
         print("LOADING: " + str(page))
         try:
-            return self.hit_cache("get", page)
+            data, t = self._hit("get", page)
+        except KeyError:
+            pass
+        else:
+            self._track_page(t)
+            return decompress_page(data)
+
+        if self.hit_miss("get", page):
+            raise PageNotFound(page)
+
+        if self.stale_while_revalidate:
+            try:
+                data, t = self._hit("get", page, stale=True)
+            except KeyError:
+                pass
+            else:
+                self._track_page(t)
+                self._revalidate(page, dict(kwargs, stop_marker=stop_marker))
+                return decompress_page(data)
+
+        result = self._coalesce(
+            "get:" + page, self._load_page, page,
+            stop_marker=stop_marker, **kwargs)
+        cached = self._lookup("get:" + page)
+        self._track_page(
+            time.time() if cached is self.EMPTY_RESULT else cached[1])
+        return result
+
+    def _load_page(self, page, **kwargs):
+        # The page might have been loaded while we were waiting.
+        try:
+            return decompress_page(self._recheck("get", page))
         except KeyError:
             pass
+        return self._fetch_page(page, **kwargs)
+
+    def _fetch_page(self, page, stop_marker=None, **kwargs):
+        # Ask the server if our expired copy is still valid.
+        cached = self._lookup("get:" + page)
+        if cached is not self.EMPTY_RESULT:
+            validators = _split_page(cached[0])[1]
+            kwargs["headers"] = dict(kwargs.get("headers", {}), **validators)
+
+        breaker = self.breakers.get(page)
+        breaker.check()
+        try:
+            response = retry(lambda: self._request(page, stop_marker, kwargs))
+        except TRANSIENT_ERRORS:
+            breaker.failure()
+            raise
+        breaker.success()
 
-        # Throtle only if we don't have a version cached.
-        if throttle:
-            time.sleep(throttle)
-        result = get(page, timeout=10, **kwargs).text
+        if response.status_code == 304 and cached is not self.EMPTY_RESULT:
+            response.close()
+            self._count("revalidations", "get")
+            self.push_cache("get", page, cached[0])
+            return decompress_page(cached[0])
+        if response.status_code == 404:
+            response.close()
+            self.push_miss("get", page)
+            raise PageNotFound(page)
+        if not 200 <= response.status_code < 300:
+            # Block pages and the like must never be cached.
+            response.close()
+            raise BadResponse(
+                "%s answered with %d" % (page, response.status_code))
 
-        self.push_cache("get", page, result)
+        if stop_marker is not None:
+            result = read_until(response, stop_marker)
+        else:
+            result = response.text
+
+        self.push_cache(
+            "get", page, compress_page(result, get_validators(response)))
         return result
 
-    def search(self, query):
+    def _request(self, page, stop_marker, kwargs):
+        self.limiter.acquire(page)
+        response = self.sessions.get(
+            page, stream=stop_marker is not None, **kwargs)
+        if response.status_code >= 500 or response.status_code == 429:
+            response.close()
+            raise ServerError(
+                "%s answered with %d" % (page, response.status_code),
+                retry_after=get_retry_after(response))
+        return response
+
+    def _revalidate(self, page, kwargs):
+        """Refreshes an expired page in the background."""
+        with self.lock:
+            if page in self._revalidating:
+                return
+            self._revalidating.add(page)
+
+        def _refresh():
+            try:
+                self._coalesce(
+                    "get:" + page, self._fetch_page, page, **kwargs)
+            except Exception:
+                bot_tools.print_exception()
+            finally:
+                with self.lock:
+                    self._revalidating.discard(page)
+
+        thread = threading.Thread(target=_refresh)
+        thread.daemon = True
+        thread.start()
+
+    def search(self, terms, site):
+        """
+        Finds the link to a story by its name.
+
+        :param terms:  The name of the story.
+        :param site:   The site of the story.
+        :returns: The link or None if the story was not found.
+        """
+        # Different spellings of the same request share one entry.
+        query = "%s %s" % (site, normalize_query(terms))
         print("SEARCHING: " + str(query))
         try:
             return self.hit_cache("search", query)
         except KeyError:
             pass
 
-        time.sleep(random.randint(2000, 5000) / 1000.0)
+        # Local answers are cheap and change as stories are loaded,
+        # so they are never cached.
+        result = self.providers.lookup(self, terms, site)
+        if result is not None:
+            return result
+
+        if self.hit_miss("search", query):
+            return None
+
+        return self._coalesce(
+            "search:" + query, self._search, query, terms, site)
+
+    def _search(self, query, terms, site):
+        # The query might have been answered while we were waiting.
+        try:
+            return self._recheck("search", query)
+        except KeyError:
+            pass
 
-        result = next(search(query, num=1, stop=1), None)
-        self.push_cache("search", query, result)
+        result = self.providers.search(self, terms, site)
+        if result is None:
+            self.push_miss("search", query)
+        else:
+            self.push_cache("search", query, result)
         return result
 
 default_cache = RequestCache()
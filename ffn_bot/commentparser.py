@@ -3,6 +3,8 @@ This file handles the comment parsing.
 """
 import re
 import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ffn_bot import site
 from ffn_bot.fetchers import SITES, get_sites
 
@@ -10,6 +12,10 @@ from ffn_bot.fetchers import SITES, get_sites
 MAX_REPLY_LENGTH = 8000
 MAX_STORIES_PER_POST = 30
 
+# The number of stories that are loaded at once.
+# The rate limiter of the cache makes sure we stay polite.
+MAX_CONCURRENT_LOADS = 8
+
 # Allow to modify the behaviour of the comments
 # by adding a special function into the system
 #
@@ -42,16 +48,8 @@ def get_direct_links(string, markers):
         yield from site.extract_direct_links(string, markers)
 
 
-def formulate_reply(comment_body, markers=None, additions=()):
-    """Creates the reply for the given comment."""
-    if markers is None:
-        # Parse the context markers as some may be required here
-        markers = parse_context_markers(comment_body)
-
-    # Ignore this message if we hit this marker
-    if "ignore" in markers:
-        return
-
+def get_requests(comment_body):
+    """Returns the (site, request_list) pairs of the comment."""
     requests = []
     # Just parse normally of nothing other turns up.
     for site in SITES:
@@ -67,6 +65,20 @@ def formulate_reply(comment_body, markers=None, additions=()):
             continue
 
         requests.append((site, request_list))
+    return requests
+
+
+def formulate_reply(comment_body, markers=None, additions=()):
+    """Creates the reply for the given comment."""
+    if markers is None:
+        # Parse the context markers as some may be required here
+        markers = parse_context_markers(comment_body)
+
+    # Ignore this message if we hit this marker
+    if "ignore" in markers:
+        return
+
+    requests = get_requests(comment_body)
 
     direct_links = additions
     if "directlinks" in markers:
@@ -81,40 +93,51 @@ def parse_comment_requests(requests, context, additions):
     Executes the queries and return the
     generated story strings as a single string
     """
-    # Merge the story-list
-    results = itertools.chain(
-        _parse_comment_requests(requests, context), additions)
+    with ThreadPoolExecutor(MAX_CONCURRENT_LOADS) as pool:
+        # Merge the story-list
+        results = list(itertools.chain(
+            _parse_comment_requests(pool, requests, context), additions))
+
+        if "nodistinct" not in context:
+            # Remove duplicates but keep the order of the requests.
+            results = list(OrderedDict.fromkeys(results))
 
-    if "nodistinct" not in context:
-        results = set(results)
+        if len(tuple(filter(
+                lambda x: isinstance(x, site.Story), results
+        ))) > MAX_STORIES_PER_POST:
+            raise StoryLimitExceeded("Maximum exceeded.")
 
-    if len(tuple(filter(
-            lambda x: isinstance(x, site.Story), results
-    ))) > MAX_STORIES_PER_POST:
-        raise StoryLimitExceeded("Maximum exceeded.")
+        # Converting a story to a string loads it.
+        parts = list(pool.map(str, results))
 
     cur_part = []
     length = 0
-    for part in results:
+    for part in parts:
         if not part:
             continue
 
-        if length + len(str(part)) >= MAX_REPLY_LENGTH:
-            yield "".join(str(p) for p in cur_part)
+        if length + len(part) >= MAX_REPLY_LENGTH:
+            yield "".join(cur_part)
             cur_part = []
             length = 0
 
         cur_part.append(part)
-        length += len(str(part))
+        length += len(part)
 
     if len(cur_part) > 0:
-        yield "".join(str(p) for p in cur_part)
+        yield "".join(cur_part)
 
 
-def _parse_comment_requests(requests, context):
+def _parse_comment_requests(pool, requests, context):
+    """Resolves all requests at once, keeping their order."""
+    jobs = []
     for site, queries in requests:
         print("Requests for '%s': %r" % (site.name, queries))
-        for comment in site.from_requests(queries, context):
+        jobs.extend((site, query) for query in queries)
+
+    for stories in pool.map(
+            lambda job: list(job[0].from_requests([job[1]], context)), jobs):
+        for comment in stories:
             if comment is None:
                 continue
             yield comment
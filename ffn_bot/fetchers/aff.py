@@ -2,7 +2,8 @@ import re
 
 from lxml import html
 
-from ffn_bot.metaparse import MetadataItem, Metaparser, parser
+from ffn_bot.metaparse import MetadataItem, Metaparser, SelectorTable
+from ffn_bot.metaparse import parser
 from ffn_bot.cache import default_cache
 from ffn_bot.site import Site
 from ffn_bot import site
@@ -27,6 +28,7 @@ AFF_LINK_REGEX = AFF_MATCH_REGEX[0]
 # As we don't have a general archive, we will need also the archive
 # Subdomain provided.
 AFF_LINK_BY_ID = "http://{0}.adult-fanfiction.org/story.php?no={1}"
+AFF_SITE = "{0}.adult-fanfiction.org"
 
 # I have no idea if it is really neccessary.
 AFF_BYPASS_COOKIE = (
@@ -36,12 +38,34 @@ AFF_BYPASS_COOKIE = (
 AFF_TITLE_XPATH = "//html/head/title/text()"
 AFF_AUTHOR_NAME = "//tr[5]/td[2]//a/text()"
 AFF_AUTHOR_URL = "//tr[5]/td[2]//a/@href"
+AFF_CATEGORY = "//tr[5]//td[1]//a/text()"
+AFF_CHAPTERS = "//select[@name='chapnav']/option"
+AFF_HITS = "//tr[5]/td[3]/text()"
+
+AFF_SELECTORS = SelectorTable(
+    "AFFPage",
+    title=AFF_TITLE_XPATH,
+    author_name=AFF_AUTHOR_NAME,
+    author_url=AFF_AUTHOR_URL,
+    category=AFF_CATEGORY,
+    chapters=AFF_CHAPTERS,
+    hits=AFF_HITS)
 
 # Since we don't have an explicit summary we will just access
 # the metadata ourselves.
 AFF_DEFAULT_SUMMARY = ""
 
 
+# Got this header from the ficsave codebase.
+# It is sent with every request to the archives.
+default_cache.sessions.configure_host(
+    "adult-fanfiction.org", {"Cookie": AFF_BYPASS_COOKIE})
+
+
+default_cache.limiter.configure_host(
+    "adult-fanfiction.org", rate=1, burst=2)
+
+
 class AFFMetadata(Metaparser):
     """
     Functions that will determine the metadata.
@@ -49,28 +73,27 @@ class AFFMetadata(Metaparser):
 
     @parser
     @staticmethod
-    def add_id(id, tree):
+    def add_id(id, page):
         for item in zip(("Archive", "ID"), id):
             yield item
 
     @parser
     @staticmethod
-    def Category(id, tree):
+    def Category(id, page):
         return " > ".join(
             x.strip().replace(" - ", "-")
-            for x in tree.xpath("//tr[5]//td[1]//a/text()")
+            for x in page.category
             if x.strip() != "Next chapter>")
 
     @parser
     @staticmethod
-    def Chapters(id, tree):
-        return len(tree.xpath("//select[@name='chapnav']/option"))
+    def Chapters(id, page):
+        return len(page.chapters)
 
     @parser
     @staticmethod
-    def Hits(id, tree):
-        return tree.xpath(
-            "//tr[5]/td[3]/text()")[0].strip()[len("Hits: "):]
+    def Hits(id, page):
+        return page.hits[0].strip()[len("Hits: "):]
 
 
 class AdultFanfiction(Site):
@@ -111,26 +134,21 @@ class Story(site.Story):
 
     def __init__(self, context, archive, id):
         super(Story, self).__init__(context)
-        self.archive = archive
+        self.archive = archive.strip().lower()
         self.id = id
+        self.key = (AFF_SITE.format(self.archive), self.id)
 
     def parse_html(self):
-        tree = html.fromstring(default_cache.get_page(
-            self.get_url(),  # Got this header from the ficsave codebase
-            headers={
-                "Cookie": AFF_BYPASS_COOKIE
-            },  # Do not even try to follow to the adult form url.
-            allow_redirects=False))
-
-        self.tree = tree
+        page = AFF_SELECTORS(html.fromstring(default_cache.get_page(
+            self.get_url(),
+            # Do not even try to follow to the adult form url.
+            allow_redirects=False)))
 
         # We will generate the stats ourselves.
-        self.stats = AFFMetadata((self.archive, self.id), tree)
-        self.title = tree.xpath(AFF_TITLE_XPATH)[0].strip()[
-            len("Story: "):
-        ]
-        self.author = tree.xpath(AFF_AUTHOR_NAME)[0].strip()
-        self.authorlink = tree.xpath(AFF_AUTHOR_URL)[0]
+        self.stats = AFFMetadata((self.archive, self.id), page)
+        self.title = page.title[0].strip()[len("Story: "):]
+        self.author = page.author_name[0].strip()
+        self.authorlink = page.author_url[0]
 
     def get_summary(self):
         return AFF_DEFAULT_SUMMARY
@@ -1,15 +1,15 @@
 import re
 import logging
 import itertools
+from urllib.parse import quote_plus
 
-from google import search
-from requests import get
-from lxml import html
+from lxml import html, etree
 from lxml.html import parse
 from lxml.cssselect import CSSSelector
 
-from ffn_bot.metaparse import Metaparser, parser
+from ffn_bot.metaparse import Metaparser, SelectorTable, parser
 from ffn_bot.cache import default_cache
+from ffn_bot.searchproviders import SearchProvider
 from ffn_bot.bot_tools import safe_int
 from ffn_bot.site import Site
 from ffn_bot import site
@@ -20,7 +20,14 @@ AO3_LINK_REGEX = AO3_LINK_REGEX = re.compile(
     r"http(s)?://([^.]+\.)?archiveofourown.org/works/(?P<sid>\d+)[^ ]*",
     re.IGNORECASE)
 AO3_FUNCTION = "linkao3"
+AO3_SITE = "archiveofourown.org"
 AO3_SEARCH_QUERY = "site:archiveofourown.org/works/ %s"
+AO3_WORK_LINK = "https://archiveofourown.org/works/%s/"
+AO3_SEARCH_URL = "{0}/works/search?work_search%5Bquery%5D={1}"
+AO3_SEARCH_RESULT = etree.XPath(
+    '//li[contains(@class, "work") and contains(@class, "blurb")]'
+    '//h4[contains(@class, "heading")]/a[1]/@href')
+AO3_SEARCH_RESULT_REGEX = re.compile(r"/works/(?P<sid>\d+)")
 AO3_AUTHOR_NAME = '//a[@rel="author"]/text()'
 AO3_AUTHOR_URL = '//a[@rel="author"]/@href'
 AO3_META_PARTS = '//dl[@class="stats"]//text()'
@@ -30,12 +37,51 @@ AO3_FANDOM_TAGS = CSSSelector("dd.fandom ul li").path + "//text()"
 AO3_EPUB_DOWNLOAD = './/a[contains(text(),"EPUB")]/@href'
 AO3_MOBI_DOWNLOAD = './/a[contains(text(),"MOBI")]/@href'
 
+AO3_SELECTORS = SelectorTable(
+    "AO3Page",
+    author_name=AO3_AUTHOR_NAME,
+    author_url=AO3_AUTHOR_URL,
+    meta_parts=AO3_META_PARTS,
+    title=AO3_TITLE,
+    summary=AO3_SUMMARY_FINDER,
+    fandom_tags=AO3_FANDOM_TAGS,
+    epub_download=AO3_EPUB_DOWNLOAD,
+    mobi_download=AO3_MOBI_DOWNLOAD)
+
+
+class AO3SearchProvider(SearchProvider):
+    """Uses the works search of the Archive of Our Own."""
+
+    name = AO3_SITE
+
+    def __init__(self, base_url="https://archiveofourown.org"):
+        self.base_url = base_url
+
+    def supports(self, site):
+        return site == AO3_SITE
+
+    def search(self, cache, terms, site):
+        page = cache.get_page(
+            AO3_SEARCH_URL.format(self.base_url, quote_plus(terms)))
+        for link in AO3_SEARCH_RESULT(html.fromstring(page)):
+            match = AO3_SEARCH_RESULT_REGEX.match(link)
+            if match is not None:
+                return AO3_WORK_LINK % match.group("sid")
+        return None
+
+
+default_cache.limiter.configure_host(AO3_SITE, rate=1 / 2, burst=3)
+default_cache.providers.get("google").configure_site(
+    AO3_SITE, AO3_SEARCH_QUERY)
+default_cache.providers.add(AO3SearchProvider())
+
+
 class AO3Metadata(Metaparser):
 
     @parser
     @staticmethod
-    def parse_fandom(id, tree):
-        res = tree.xpath(AO3_FANDOM_TAGS)
+    def parse_fandom(id, page):
+        res = page.fandom_tags
         if len(res) > 1:
             yield "Fandoms", ", ".join(res)
         elif len(res) == 0:
@@ -45,8 +91,8 @@ class AO3Metadata(Metaparser):
 
     @parser
     @staticmethod
-    def parse_basemeta(id, tree):
-        res = tree.xpath(AO3_META_PARTS)
+    def parse_basemeta(id, page):
+        res = page.meta_parts
 
         yield from (
             (k[:-1], v)
@@ -55,7 +101,7 @@ class AO3Metadata(Metaparser):
 
     @parser
     @staticmethod
-    def ID(id, tree):
+    def ID(id, page):
         return id
 
 
@@ -89,7 +135,7 @@ class ArchiveOfOurOwn(Site):
         return self.generate_response(link, context)
 
     def _id_to_link(self, id):
-        return "https://archiveofourown.org/works/%s/" % id
+        return AO3_WORK_LINK % id
 
     def find_link(self, request, context):
         # Find link by ID.
@@ -100,9 +146,9 @@ class ArchiveOfOurOwn(Site):
 # Filter out direct links.
         match = AO3_LINK_REGEX.match(request)
         if match is not None:
-            return request
+            return self._id_to_link(match.group("sid"))
 
-        return default_cache.search(AO3_SEARCH_QUERY % request)
+        return default_cache.search(request, AO3_SITE)
 
     def generate_response(self, link, context):
         assert link is not None
@@ -122,9 +168,18 @@ class ArchiveOfOurOwn(Site):
 
 class Story(site.Story):
 
+    # The chapter text follows the metadata and the summary.
+    STOP_MARKER = re.compile(br"""id=['"]?chapters\b""")
+
+    # Skip the navigation of the site and the chapters.
+    REGION_START = re.compile(r"""id=['"]?main\b""")
+    REGION_END = re.compile(r"""id=['"]?chapters\b""")
+
     def __init__(self, url, context=None):
         super(Story, self).__init__(context)
         self.url = url
+        self.sid = AO3_LINK_REGEX.match(url).group("sid")
+        self.key = (AO3_SITE, self.sid)
         self.raw_stats = []
         self.stats = ""
         self.title = ""
@@ -133,28 +188,26 @@ class Story(site.Story):
         self.summary = ""
 
     def get_real_url(self):
-        return "https://archiveofourown.org/works/%s?view_adult=true" % AO3_LINK_REGEX.match(self.url).groupdict()["sid"]
+        return "https://archiveofourown.org/works/%s?view_adult=true" % self.sid
 
     def get_url(self):
-        return "https://archiveofourown.org/works/%s" % AO3_LINK_REGEX.match(self.url).groupdict()["sid"]
+        return "https://archiveofourown.org/works/%s" % self.sid
 
-    def get_value_from_tree(self, xpath, sep=""):
-        return sep.join(self.tree.xpath(xpath)).strip()
+    @staticmethod
+    def get_value(result, sep=""):
+        return sep.join(result).strip()
 
     def parse_html(self):
-        page = default_cache.get_page(self.get_real_url())
-        self.tree = html.fromstring(page)
-        self.summary = self.get_value_from_tree(AO3_SUMMARY_FINDER)
-        self.title = self.get_value_from_tree(AO3_TITLE)
-        self.author = self.get_value_from_tree(AO3_AUTHOR_NAME)
-        self.authorlink = "https://www.archiveofourown.org" + self.get_value_from_tree(AO3_AUTHOR_URL)
-        self.stats = AO3Metadata(
-            AO3_LINK_REGEX.match(self.url).groupdict()["sid"], self.tree)
+        page = AO3_SELECTORS(self.parse_page(default_cache.get_page(
+            self.get_real_url(), stop_marker=self.STOP_MARKER)))
+        self.summary = self.get_value(page.summary)
+        self.title = self.get_value(page.title)
+        self.author = self.get_value(page.author_name)
+        self.authorlink = "https://www.archiveofourown.org" + self.get_value(page.author_url)
+        self.stats = AO3Metadata(self.sid, page)
+        self.download = (
+            "https://archiveofourown.org" + self.get_value(page.epub_download),
+            "https://archiveofourown.org" + self.get_value(page.mobi_download))
 
     def get_site(self):
         return "Archive of Our Own", "https://www.archiveofourown.org/"
-
-    def get_download(self):
-        epub_download = "https://archiveofourown.org" + self.get_value_from_tree(AO3_EPUB_DOWNLOAD)
-        mobi_download = "https://archiveofourown.org" + self.get_value_from_tree(AO3_MOBI_DOWNLOAD)
-        return(epub_download, mobi_download)
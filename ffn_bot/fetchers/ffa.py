@@ -9,13 +9,14 @@ from ffn_bot.cache import default_cache
 from ffn_bot.bot_tools import safe_int
 from ffn_bot.site import Site
 from ffn_bot import site
-from ffn_bot.metaparse import Metaparser, parser
+from ffn_bot.metaparse import Metaparser, SelectorTable, parser
 
 __all__ = ["HPFanfictionArchive"]
 
 FFA_LINK_REGEX = re.compile(
     r"http(?:s)?://www\.hpfanficarchive\.com/stories/viewstory\.php\?sid=(?P<sid>\d+)", re.IGNORECASE)
 FFA_FUNCTION = "linkffa"
+FFA_SITE = "hpfanficarchive.com"
 FFA_SEARCH_QUERY = "http://www.hpfanficarchive.com/stories/viewstory.php?sid= %s"
 
 FFA_AUTHOR_NAME = '//*[@id="pagetitle"]/a[2]/text()'
@@ -23,28 +24,41 @@ FFA_AUTHOR_URL = '//*[@id="pagetitle"]/a[2]/@href'
 FFA_SUMMARY_AND_META = '//*[@id="mainpage"]/div[4]//text()'
 FFA_TITLE = '//*[@id="pagetitle"]/a[1]/text()'
 
+FFA_SELECTORS = SelectorTable(
+    "FFAPage",
+    author_name=FFA_AUTHOR_NAME,
+    author_url=FFA_AUTHOR_URL,
+    summary_and_meta=FFA_SUMMARY_AND_META,
+    title=FFA_TITLE)
+
 FFA_SPLITTER_REGEX = re.compile(
     "[A-Z][a-z ]*?[a-z]*?:.*?(?=\s*[A-Z](?:[a-z ]*?[a-z]*?:))"
 )
+FFA_SUMMARY_REGEX = re.compile('Summary: (.*?)(?=Rated:)', re.DOTALL)
+FFA_WHITESPACE_REGEX = re.compile(r"\s+")
+
+
+default_cache.limiter.configure_host(FFA_SITE, rate=1, burst=2)
+default_cache.providers.get("google").configure_site(
+    FFA_SITE, FFA_SEARCH_QUERY)
 
 
 class FFAMetadata(Metaparser):
 
     @parser
     @staticmethod
-    def parse_metadata(id, tree):
-        summary_and_meta = ' '.join(tree.xpath(FFA_SUMMARY_AND_META))
+    def parse_metadata(id, summary_and_meta):
         stats = summary_and_meta.split("Rated: ")
         stats[1] = "Rated: " + stats[1]
         stats = stats[1]
-        stats = re.sub("\s+", " ", stats.replace("\n", " "))
+        stats = FFA_WHITESPACE_REGEX.sub(" ", stats.replace("\n", " "))
         stats = FFA_SPLITTER_REGEX.findall(stats)
         for l in stats:
             yield tuple(p.strip() for p in l.split(":", 2))
 
     @parser
     @staticmethod
-    def ID(id, tree):
+    def ID(id, summary_and_meta):
         return id
 
 
@@ -89,9 +103,9 @@ class HPFanfictionArchive(Site):
         # Filter out direct links.
         match = FFA_LINK_REGEX.match(request)
         if match is not None:
-            return request
+            return self.id_to_url(match.group("sid"))
 
-        return default_cache.search(FFA_SEARCH_QUERY % request)
+        return default_cache.search(request, FFA_SITE)
 
     def generate_response(self, link, context):
         assert link is not None
@@ -112,6 +126,8 @@ class Story(site.Story):
     def __init__(self, url, context=None):
         super(Story, self).__init__(context)
         self.url = url
+        self.sid = FFA_LINK_REGEX.match(url).group("sid")
+        self.key = (FFA_SITE, self.sid)
         self.raw_stats = []
 
         self.stats = ""
@@ -122,30 +138,22 @@ class Story(site.Story):
         self.summary_and_meta = ""
 
     def get_url(self):
-        return HPFanfictionArchive.id_to_url(
-            str(FFA_LINK_REGEX.match(self.url).groupdict()["sid"])
-        )
+        return HPFanfictionArchive.id_to_url(self.sid)
 
     def parse_html(self):
-        self.tree = tree = html.fromstring(default_cache.get_page(self.url))
+        page = FFA_SELECTORS(
+            html.fromstring(default_cache.get_page(self.get_url())))
 
-        self.summary_and_meta = ' '.join(tree.xpath(FFA_SUMMARY_AND_META))
+        # The summary and the metadata share the same text.
+        self.summary_and_meta = ' '.join(page.summary_and_meta)
         self.summary = ''.join(
-            re.findall(
-                'Summary: (.*?)(?=Rated:)',
-                self.summary_and_meta,
-                re.DOTALL
-            )
+            FFA_SUMMARY_REGEX.findall(self.summary_and_meta)
         ).replace("\n", " ").strip()
-        self.stats = FFAMetadata(
-            str(FFA_LINK_REGEX.match(self.url).groupdict()["sid"]),
-            self.tree
-
-        )
-        self.title = tree.xpath(FFA_TITLE)[0]
-        self.author = tree.xpath(FFA_AUTHOR_NAME)[0]
+        self.stats = FFAMetadata(self.sid, self.summary_and_meta)
+        self.title = page.title[0]
+        self.author = page.author_name[0]
         self.authorlink = 'http://www.hpfanficarchive.com/stories/' + \
-            tree.xpath(FFA_AUTHOR_URL)[0]
+            page.author_url[0]
 
     def get_site(self):
         return "HP Fanfic Archive", "http://www.hpfanficarchive.com"
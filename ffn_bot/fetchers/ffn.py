@@ -1,16 +1,39 @@
 import re
+from collections import namedtuple
+from urllib.parse import quote_plus
+
 from ffn_bot import bot_tools
 from ffn_bot import site
 from ffn_bot.cache import default_cache
+from ffn_bot.searchproviders import SearchProvider
 from ffn_bot.metaparse import Metaparser, parser
 
-from random import randint
-from lxml import html
+from lxml import html, etree
 
 __all__ = ["FanfictionNetSite", "FictionPressSite"]
 
 LINK_REGEX = "http(s?)://((www|m)\\.)?%s/s/(?P<sid>\\d+).*"
 ID_LINK = "https://www.{0}/s/%s"
+SEARCH_QUERY = "site:www.{0}/s/ %s"
+
+SEARCH_URL = "{0}/search/?keywords={1}&ready=1&type=story"
+SEARCH_RESULT = etree.XPath(
+    '//div[contains(@class, "z-list")]/a[contains(@class, "stitle")]/@href')
+SEARCH_RESULT_REGEX = re.compile(r"/s/(?P<sid>\d+)")
+
+# All fields of a story are found below #profile_top.
+PROFILE_TOP = etree.XPath('//*[@id="profile_top"]')
+PROFILE_TITLE = etree.XPath('b/text()')
+PROFILE_SUMMARY = etree.XPath('div/text()')
+PROFILE_AUTHOR_NAME = etree.XPath('a[1]/text()')
+PROFILE_AUTHOR_URL = etree.XPath('a[1]/@href')
+PROFILE_HAS_IMAGE = etree.XPath('boolean(span[1]/img)')
+PROFILE_INFO_WITH_IMAGE = etree.XPath('string(span[4])')
+PROFILE_INFO = etree.XPath('string(span[3])')
+CATEGORY = etree.XPath('//*[@id="pre_story_links"]/span/a[last()]/text()')
+
+INFO_PART_SPLIT = re.compile(r"\s+-\s+")
+INFO_NAME_SPLIT = re.compile(r":\s+")
 
 FFN_GENRES = [
     "Adventure", "Angst", "Crime", "Drama", "Family", "Fantasy",
@@ -25,46 +48,86 @@ DOMAIN_TO_ARCHIVE_NAME = {
 }
 
 
-class FanfictionParser(Metaparser):
-    CATEGORY_TYPE = "Category"
+class FanfictionSearchProvider(SearchProvider):
+    """Uses the story search of FanFiction.Net and FictionPress."""
 
-    @staticmethod
-    def get_story_information(tree):
-        if tree.xpath('//*[@id="profile_top"]/span[1]/img'):
-            return "".join(
-                tree.xpath('//*[@id="profile_top"]/span[4]//text()'))
+    def __init__(self, site, base_url=None):
+        self.name = site
+        self.site = site
+        if base_url is None:
+            base_url = "https://www." + site
+        self.base_url = base_url
+
+    def supports(self, site):
+        return site == self.site
+
+    def search(self, cache, terms, site):
+        page = cache.get_page(
+            SEARCH_URL.format(self.base_url, quote_plus(terms)))
+        for link in SEARCH_RESULT(html.fromstring(page)):
+            match = SEARCH_RESULT_REGEX.match(link)
+            if match is not None:
+                return ID_LINK.format(self.site) % match.group("sid")
+        return None
+
+
+for _domain in DOMAIN_TO_ARCHIVE_NAME:
+    # Do not send more than one request every two seconds on average.
+    default_cache.limiter.configure_host(_domain, rate=1 / 2, burst=3)
+    default_cache.providers.get("google").configure_site(
+        _domain, SEARCH_QUERY.format(_domain))
+    default_cache.providers.add(FanfictionSearchProvider(_domain))
+
+
+# The story information of a page, split into its parts once.
+StoryInformation = namedtuple("StoryInformation", "category named unnamed")
+
+
+def get_story_information(tree, profile):
+    """
+    Extracts the story information below #profile_top.
+
+    :param tree:     The page.
+    :param profile:  The #profile_top element of the page.
+    :returns: A StoryInformation with the category, the
+              (name, value) pairs and the unnamed parts.
+    """
+    if PROFILE_HAS_IMAGE(profile):
+        info = PROFILE_INFO_WITH_IMAGE(profile)
+    else:
+        info = PROFILE_INFO(profile)
+
+    named = []
+    unnamed = []
+    for part in INFO_PART_SPLIT.split(info):
+        subparts = INFO_NAME_SPLIT.split(part)
+        if len(subparts) == 2:
+            named.append(subparts)
         else:
-            return "".join(
-                tree.xpath('//*[@id="profile_top"]/span[3]//text()'))
+            unnamed.append(subparts[0])
+    return StoryInformation(CATEGORY(tree)[0], named, unnamed)
+
+
+class FanfictionParser(Metaparser):
+    """Formats the StoryInformation of a story."""
+
+    CATEGORY_TYPE = "Category"
 
     @parser
     @classmethod
-    def parse_category(cls, id, tree):
-        return (
-            cls.CATEGORY_TYPE, tree.xpath(
-                '//*[@id="pre_story_links"]/span/a[last()]/text()')[0]
-        )
+    def parse_category(cls, id, info):
+        return cls.CATEGORY_TYPE, info.category
 
     @parser
     @classmethod
-    def parse_metadata_simple(cls, id, tree):
-        story_info = cls.get_story_information(tree)
-        for part in re.split(r"\s+-\s+", story_info):
-            subparts = re.split(r":\s+", part)
-            if len(subparts) == 2:
-                yield subparts
+    def parse_metadata_simple(cls, id, info):
+        yield from info.named
 
     @parser
     @classmethod
-    def parse_unnamed_parts(cls, id, tree):
+    def parse_unnamed_parts(cls, id, info):
         n_unnamed = 0
-        story_info = cls.get_story_information(tree)
-        for part in re.split(r"\s+-\s+", story_info):
-            subparts = re.split(r":\s+", part)
-            if len(subparts) == 2:
-                continue
-
-            subpart = subparts[0]
+        for subpart in info.unnamed:
             if n_unnamed == 0:
                 yield "Language", subpart
             elif (
@@ -131,10 +194,9 @@ class FanfictionBaseSite(site.Site):
 # Yield links directly without googling.
         match = self.link_regex.match(fic_name)
         if match is not None:
-            return fic_name
+            return self.id_link % match.group("sid")
 
-        search_request = 'site:www.{1}/s/ {0}'.format(fic_name, self.site)
-        return default_cache.search(search_request)
+        return default_cache.search(fic_name, self.site)
 
     def extract_direct_links(self, body, context):
         return (
@@ -145,10 +207,21 @@ class FanfictionBaseSite(site.Site):
 
 class Story(site.Story):
 
+    # The chapter text follows the metadata.
+    STOP_MARKER = re.compile(br"""id=['"]?storytext\b""")
+
+    # The category precedes the profile, the chapter text follows it.
+    REGION_START = re.compile(r"""id=['"]?pre_story_links\b""")
+    REGION_END = re.compile(r"""id=['"]?storytext\b""")
+
     def __init__(self, url, site, context, parser):
         super(Story, self).__init__(context)
         self.url = url
         self.site = site
+        self.sid = re.match(
+            LINK_REGEX % re.escape(site), url, re.IGNORECASE
+        ).group("sid")
+        self.key = (site, self.sid)
         self.stats = ""
 
         self.title = ""
@@ -159,30 +232,27 @@ class Story(site.Story):
         self.parser = parser
 
     def get_url(self):
-        return "https://www.%s/s/%s/1/" % (
-            self.site,
-            re.match(LINK_REGEX % self.site, self.url).groupdict()["sid"])
+        return "https://www.%s/s/%s/1/" % (self.site, self.sid)
 
     def parse_html(self):
         page = default_cache.get_page(
-            self.get_url(),
-            throttle=randint(1000, 4000) / 1000)
-        tree = html.fromstring(page)
+            self.get_url(), stop_marker=self.STOP_MARKER)
+        tree = self.parse_page(page)
+
+        profile = PROFILE_TOP(tree)
+        if not profile:
+            raise site.StoryDoesNotExist
+        profile = profile[0]
 
-        self.title = (tree.xpath('//*[@id="profile_top"]/b/text()'))
-        if not len(self.title):
+        title = PROFILE_TITLE(profile)
+        if not title:
             raise site.StoryDoesNotExist
-        self.title = self.title[0]
-        self.summary = (tree.xpath('//*[@id="profile_top"]/div/text()'))[0
-                                                                         ]
-        self.author += (tree.xpath('//*[@id="profile_top"]/a[1]/text()'))[
-            0
-        ]
-        self.authorlink = 'https://www.' + self.site + tree.xpath(
-            '//*[@id="profile_top"]/a[1]/@href')[0]
-        self.image = tree.xpath('//*[@id="profile_top"]/span[1]/img')
-        self.tree = tree
-        self.stats = self.parser(None, tree)
+        self.title = title[0]
+        self.summary = PROFILE_SUMMARY(profile)[0]
+        self.author = PROFILE_AUTHOR_NAME(profile)[0]
+        self.authorlink = (
+            'https://www.' + self.site + PROFILE_AUTHOR_URL(profile)[0])
+        self.stats = self.parser(None, get_story_information(tree, profile))
 
     def get_site(self):
         link = "https://www." + self.site + "/"
@@ -190,14 +260,14 @@ class Story(site.Story):
 
     def get_download(self):
         # Return (epub,mobi) download URLs in tuple.
-        if "fictionpress" in self.url:
+        if "fictionpress" in self.site:
             return ("http://ficsave.com/?story_url={0}&format=epub&auto_download=yes".format(self.url),
                     "http://ficsave.com/?story_url={0}&format=mobi&auto_download=yes".format(self.url))
         else:
             return ("http://www.ff2ebook.com/old/ffn-bot/index.php?id={0}&source=ff&filetype=epub".format(
-                re.findall(r'\d+', self.url)[0]),
+                self.sid),
                 "http://www.ff2ebook.com/old/ffn-bot/index.php?id={0}&source=ff&filetype=mobi".format(
-                re.findall(r'\d+', self.url)[0]))
+                self.sid))
 
 
 class FanfictionNetSite(FanfictionBaseSite):
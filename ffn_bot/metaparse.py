@@ -5,6 +5,8 @@ import inspect
 import functools
 import collections
 
+from lxml import etree
+
 
 basestring = (str, bytes)
 MetadataItem = collections.namedtuple("MetadataItem", "name value")
@@ -87,6 +89,27 @@ class Metaparser(metaclass=MetaparserMeta):
         return join(map((lambda i: itemfmt(*i)), cls(id, tree).items()))
 
 
+class SelectorTable(object):
+
+    """
+    A table of precompiled XPath selectors for a page.
+
+    Calling the table evaluates every selector once and returns
+    the results as a namedtuple, so a story and its Metaparser
+    can share them.
+    """
+
+    def __init__(self, typename, **selectors):
+        self.selectors = [
+            (field, etree.XPath(xpath)) for field, xpath in selectors.items()]
+        self.result_type = collections.namedtuple(
+            typename, [field for field, _ in self.selectors])
+
+    def __call__(self, tree):
+        return self.result_type(
+            *(selector(tree) for _, selector in self.selectors))
+
+
 def parser(func):
     func._parser = True
     return func
@@ -0,0 +1,497 @@
+"""
+This module handles the connections to the archives.
+"""
+import json
+import time
+import random
+import shelve
+import hashlib
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+class ServerError(IOError):
+    """
+    Raised when the server answers with a 5xx or 429 status.
+
+    :ivar retry_after: Seconds the server asked us to wait or None.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(ServerError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(IOError):
+    """Raised instead of sending a request to a site that is down."""
+    pass
+
+
+# Errors that might go away if we try again.
+TRANSIENT_ERRORS = (
+    requests.ConnectionError, requests.Timeout, ServerError
+)
+
+
+# We never wait longer than this before a retry, whatever the
+# server asks for.
+MAX_RETRY_AFTER = 60
+
+
+def retry(func, attempts=3, backoff=1, errors=TRANSIENT_ERRORS):
+    """
+    Calls the function until it does not raise one of the errors.
+
+    Waits a random time up to `backoff * 2**n` seconds before
+    the n-th retry, so that retries of many threads spread out.
+    If the server told us how long to wait, we wait at least that long.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except errors as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, backoff * 2 ** attempt)
+            delay = max(delay, getattr(e, "retry_after", None) or 0)
+        time.sleep(delay)
+
+
+def get_retry_after(response):
+    """
+    Returns the seconds the Retry-After header asks us to wait.
+
+    :returns: The seconds, at most MAX_RETRY_AFTER, or None if
+              the header is missing or invalid.
+    """
+    value = response.headers.get("Retry-After", "").strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = mktime_tz(date) - time.time()
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+def get_host(url):
+    """Returns the lowercase host name of the url."""
+    return (urlparse(url).hostname or "").lower()
+
+
+def match_domain(host, domains):
+    """Returns all domains the host belongs to."""
+    return [
+        domain for domain in domains
+        if host == domain or host.endswith("." + domain)
+    ]
+
+
+class TokenBucket(object):
+
+    """
+    Allows `rate` requests per second on average and bursts of
+    up to `burst` requests after idle times.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the next request may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # Reserve our token even if we have to wait for it, so
+            # waiting threads are served in order.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+
+    """
+    Keeps a token bucket for every site.
+
+    Hosts of a configured domain share the bucket of the domain,
+    all other hosts get a bucket with the default rate.
+    """
+
+    def __init__(self, rate=1, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.domains = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def configure_host(self, domain, rate, burst=1):
+        """Sets the rate for a domain and all its subdomains."""
+        domain = domain.lower()
+        with self.lock:
+            self.domains[domain] = (rate, burst)
+            self.buckets.pop(domain, None)
+
+    def _get_bucket(self, host):
+        with self.lock:
+            domains = match_domain(host, self.domains)
+            if domains:
+                # Prefer the most specific domain.
+                key = max(domains, key=len)
+                rate, burst = self.domains[key]
+            else:
+                key = host
+                rate, burst = self.rate, self.burst
+
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def acquire(self, url):
+        """Blocks until a request to the host of the url may be sent."""
+        self._get_bucket(get_host(url)).acquire()
+
+
+# Bytes after the marker that are still read and thrown away, so
+# the connection can be reused instead of being closed.
+DRAIN_LIMIT = 64 * 1024
+
+
+def read_until(response, marker, chunk_size=16 * 1024, overlap=256,
+               drain_limit=DRAIN_LIMIT):
+    """
+    Reads the body of a streamed response until the marker is found.
+
+    If the rest of the body is small, it is read and discarded so the
+    connection goes back to the pool. Otherwise the rest is never
+    downloaded and the connection is closed.
+
+    :param marker:  A compiled regular expression for bytes.
+    :param overlap: How many bytes before a new chunk are searched
+                    again, so markers crossing chunks are found.
+    :param drain_limit: How many bytes after the marker may be read.
+    """
+    body = bytearray()
+    chunks = response.iter_content(chunk_size)
+    try:
+        for chunk in chunks:
+            start = max(0, len(body) - overlap)
+            body.extend(chunk)
+            if marker.search(body, start) is not None:
+                _drain(response, chunks, drain_limit)
+                break
+    finally:
+        response.close()
+    return body.decode(response.encoding or "utf-8", errors="replace")
+
+
+def _drain(response, chunks, limit):
+    # Do not even start if the server told us the rest is too large.
+    length = response.headers.get("Content-Length", "")
+    raw = getattr(response, "raw", None)
+    if length.isdigit() and hasattr(raw, "tell"):
+        if int(length) - raw.tell() > limit:
+            return
+
+    read = 0
+    for chunk in chunks:
+        read += len(chunk)
+        if read > limit:
+            return
+
+
+class CircuitBreaker(object):
+
+    """
+    Stops sending requests to a site that keeps failing.
+
+    After `threshold` consecutive failures all requests fail
+    immediately for `cooldown` seconds. Then a single request is
+    let through again; if it succeeds, the site is considered up.
+    """
+
+    def __init__(self, threshold=5, cooldown=5 * 60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Raises CircuitOpen if no request may be sent."""
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.monotonic() - self.opened < self.cooldown:
+                raise CircuitOpen("Site is failing. Not sending requests.")
+            # Let this request probe the site and fail the others until
+            # it returns.
+            self.opened = time.monotonic()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+
+class CircuitBreakers(object):
+
+    """Keeps a circuit breaker for every host."""
+
+    def __init__(self, threshold=5, cooldown=5 * 60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """Returns the circuit breaker of the host of the url."""
+        host = get_host(url)
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker(
+                    self.threshold, self.cooldown)
+        return breaker
+
+
+# Response headers with session secrets that are never archived.
+PRIVATE_HEADERS = (
+    "Set-Cookie", "Set-Cookie2", "Authorization", "Proxy-Authorization"
+)
+
+# Form fields and JSON values with credentials or session secrets,
+# like those of the reddit login. They are left out of the keys and
+# blanked in the stored responses.
+SECRET_FIELDS = frozenset((
+    "passwd", "password", "client_secret", "refresh_token",
+    "access_token", "modhash", "cookie",
+))
+
+
+def strip_secret_fields(body):
+    """Removes the secret fields from a form encoded body."""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    try:
+        fields = parse_qsl(body, keep_blank_values=True, strict_parsing=True)
+    except ValueError:
+        # Not a form.
+        return body
+    return urlencode([(k, v) for k, v in fields if k not in SECRET_FIELDS])
+
+
+def redact_secret_fields(content):
+    """Blanks the secret values of a JSON response body."""
+    try:
+        data = json.loads(content.decode("utf-8"))
+    except ValueError:
+        return content
+
+    def redact(value):
+        if isinstance(value, dict):
+            return dict(
+                (k, "" if k in SECRET_FIELDS else redact(v))
+                for k, v in value.items())
+        if isinstance(value, list):
+            return [redact(item) for item in value]
+        return value
+
+    redacted = redact(data)
+    if redacted == data:
+        return content
+    return json.dumps(redacted).encode("utf-8")
+
+
+class HTTPArchive(object):
+
+    """
+    Stores responses in a file so they can be replayed later.
+
+    Responses are keyed by method, url and a hash of the request body
+    without its secret fields.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = shelve.open(filename)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(method, url, body=None):
+        key = method.upper() + " " + url
+        if body:
+            body = strip_secret_fields(body).encode("utf-8")
+            key += " " + hashlib.sha1(body).hexdigest()
+        return key
+
+    def store(self, key, status, headers, content):
+        """Stores the response without its secrets."""
+        headers = CaseInsensitiveDict(headers)
+        for name in PRIVATE_HEADERS:
+            headers.pop(name, None)
+        content = redact_secret_fields(content)
+        with self.lock:
+            self.db[key] = (status, dict(headers), content)
+            self.db.sync()
+
+    def load(self, key):
+        """Returns the (status, headers, content) tuple of the response."""
+        with self.lock:
+            return self.db[key]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ArchiveAdapter(HTTPAdapter):
+
+    """
+    Transport adapter that works with an HTTPArchive.
+
+    In "record" mode all responses are sent over the network and
+    written to the archive. In "replay" mode all responses are read
+    from the archive and nothing is sent.
+    """
+
+    def __init__(self, archive, mode, **kwargs):
+        super(ArchiveAdapter, self).__init__(**kwargs)
+        if mode not in ("record", "replay"):
+            raise ValueError("Unknown archive mode: " + mode)
+        self.archive = archive
+        self.mode = mode
+
+    def send(self, request, stream=False, **kwargs):
+        key = self.archive.key(request.method, request.url, request.body)
+        if self.mode == "replay":
+            return self._replay(request, key)
+
+        # We need the whole body to store it.
+        response = super(ArchiveAdapter, self).send(
+            request, stream=False, **kwargs)
+
+        # A 304 means nothing without the page we had before.
+        if response.status_code != 304:
+            self.archive.store(
+                key, response.status_code, response.headers,
+                response.content)
+        return response
+
+    def _replay(self, request, key):
+        try:
+            status, headers, content = self.archive.load(key)
+        except KeyError:
+            raise requests.ConnectionError(
+                "Not in the archive: " + key, request=request)
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+class SessionPool(object):
+
+    """
+    Keeps a keep-alive session for every host.
+
+    Consecutive requests to the same host reuse their connections
+    instead of doing a new TCP and TLS handshake every time.
+    """
+
+    def __init__(self, pool_size=4, timeout=10, headers=None):
+        """
+        :param pool_size:  The number of connections kept per host.
+        :param timeout:    The default timeout of a request in seconds.
+        :param headers:    Default headers sent to all hosts.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.host_headers = {}
+        self.sessions = {}
+        self.adapter = None
+        self.lock = threading.Lock()
+
+    def configure_host(self, domain, headers):
+        """
+        Sets default headers for a domain and all its subdomains.
+
+        Only affects sessions that have not been created yet.
+        """
+        self.host_headers[domain.lower()] = headers
+
+    def _headers_for(self, host):
+        headers = dict(self.headers)
+        for domain in match_domain(host, self.host_headers):
+            headers.update(self.host_headers[domain])
+        return headers
+
+    def install_adapter(self, adapter):
+        """Uses the transport adapter for all sessions."""
+        with self.lock:
+            self.adapter = adapter
+            for session in self.sessions.values():
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+    def _create_session(self, host):
+        session = requests.Session()
+        adapter = self.adapter
+        if adapter is None:
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self._headers_for(host))
+        return session
+
+    def get_session(self, url):
+        """Returns the session for the host of the url."""
+        host = get_host(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = self._create_session(host)
+        return session
+
+    def get(self, url, **kwargs):
+        """Sends a GET request using the session of the host."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.get_session(url).get(url, **kwargs)
+
+    def close(self):
+        """Closes all connections."""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
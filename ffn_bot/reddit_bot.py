@@ -1,15 +1,22 @@
 import sys
+import json
+import signal
 import argparse
 import logging
 import praw
 import time
 from praw.objects import Submission
 import re
+import google
 
 from ffn_bot.commentlist import CommentList
 from ffn_bot.commentparser import formulate_reply, parse_context_markers
-from ffn_bot.commentparser import get_direct_links
+from ffn_bot.commentparser import get_direct_links, get_requests
 from ffn_bot.commentparser import StoryLimitExceeded
+from ffn_bot.cache import default_cache, SQLiteStorage
+from ffn_bot.searchindex import default_index
+from ffn_bot.searchqueue import SearchQueue
+from ffn_bot.network import HTTPArchive, ArchiveAdapter, RateLimiter
 from ffn_bot import reddit_markdown
 from ffn_bot import bot_tools
 
@@ -43,10 +50,35 @@ DRY_RUN = False
 # Please use with caution
 USE_STREAMS = False
 
+# The archive all HTTP traffic is recorded to or replayed from.
+HTTP_ARCHIVE = None
+
+# The file the cache is saved to on shutdown.
+CACHE_SNAPSHOT = None
+
+# The file the search index is saved to on shutdown.
+SEARCH_INDEX = None
+
+# Seconds between two reports of the cache statistics.
+CACHE_STATS_INTERVAL = 10 * 60
+LAST_CACHE_STATS = time.time()
+
+# Seconds between two saves of the cache snapshot and the search index
+# while the bot is running, in case it is killed without warning.
+SNAPSHOT_INTERVAL = 30 * 60
+LAST_SNAPSHOT = time.time()
+
 def run_forever():
+    # Shut down cleanly when we are stopped by systemd or docker.
+    signal.signal(signal.SIGTERM, _terminate)
     sys.exit(_run_forever())
 
 
+def _terminate(signum, frame):
+    """Turns SIGTERM into SystemExit, so the snapshots are written."""
+    sys.exit(0)
+
+
 def _run_forever():
     """Run-Forever"""
     while True:
@@ -64,6 +96,7 @@ def _run_forever():
         finally:
             if CHECKED_COMMENTS is not None:
                 CHECKED_COMMENTS.save()
+            save_snapshots(force=True)
 
 
 def main():
@@ -71,6 +104,7 @@ def main():
     # moved call for agruments to avoid double calling
     global bot_parameters
     bot_parameters = get_bot_parameters()
+    init_http_archive(bot_parameters)
     login_to_reddit(bot_parameters)
     load_subreddits(bot_parameters)
     init_global_flags(bot_parameters)
@@ -98,6 +132,7 @@ def main():
 
 def init_global_flags(bot_parameters):
     global USE_GET_COMMENTS, DRY_RUN, CHECKED_COMMENTS, USE_STREAMS
+    global CACHE_SNAPSHOT, SEARCH_INDEX
 
     if bot_parameters["experimental"]["streams"]:
         print("You are using the stream approach.")
@@ -112,10 +147,57 @@ def init_global_flags(bot_parameters):
 
     CHECKED_COMMENTS = CommentList(bot_parameters["comments"], DRY_RUN)
 
+    # Only open the cache file once as main() is called again after
+    # each crash.
+    if bot_parameters["cache"] is not None and default_cache.storage is None:
+        print("Using persistent cache:", bot_parameters["cache"])
+        default_cache.storage = SQLiteStorage(bot_parameters["cache"])
+        logging.info(
+            "Removed %d expired entries from the persistent cache."
+            % default_cache.prune())
+    default_cache.resize(bot_parameters["cache_size"] * 1024 * 1024)
+    default_cache.stale_while_revalidate = bot_parameters["stale_cache"]
+
+    # Warm up the cache on the first start only.
+    if bot_parameters["cache_snapshot"] is not None and CACHE_SNAPSHOT is None:
+        CACHE_SNAPSHOT = bot_parameters["cache_snapshot"]
+        load_cache_snapshot()
+
+    if bot_parameters["search_index"] is not None and SEARCH_INDEX is None:
+        SEARCH_INDEX = bot_parameters["search_index"]
+        load_search_index()
+
     level = getattr(logging, bot_parameters["verbosity"].upper())
     logging.getLogger().setLevel(level)
 
 
+def init_http_archive(bot_parameters):
+    """Records or replays all HTTP traffic if requested."""
+    global HTTP_ARCHIVE
+    if HTTP_ARCHIVE is not None:
+        return
+
+    if bot_parameters["replay"] is not None:
+        filename, mode = bot_parameters["replay"], "replay"
+        # There is no site we could overload.
+        default_cache.limiter = RateLimiter(rate=1e9, burst=1e9)
+    elif bot_parameters["record"] is not None:
+        filename, mode = bot_parameters["record"], "record"
+    else:
+        return
+
+    print("Using HTTP archive in %s mode: %s" % (mode, filename))
+    HTTP_ARCHIVE = HTTPArchive(filename)
+    adapter = ArchiveAdapter(HTTP_ARCHIVE, mode)
+    default_cache.sessions.install_adapter(adapter)
+    # Replays must not depend on the cookies we had while recording.
+    google.always_fetch_home = True
+    # praw sends all requests through the session of its handler.
+    for session in (r.handler.http, google.session):
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+
 def get_bot_parameters():
     """Parse the command-line arguments."""
     # initialize parser and add options for username and password
@@ -140,6 +222,51 @@ def get_bot_parameters():
         help="Filename where comments are stored",
         default="CHECKED_COMMENTS.txt")
 
+    parser.add_argument(
+        '--cache',
+        help="Filename of the persistent page and search cache. "
+             "(Defaults to an in-memory cache)",
+        default=None)
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        help="Memory budget of the cache in megabytes.",
+        default=64)
+
+    parser.add_argument(
+        '--stale-cache',
+        action='store_true',
+        help="Reply with expired pages and refresh them in the background.")
+
+    parser.add_argument(
+        '--cache-snapshot',
+        help="Filename of the cache snapshot that is loaded on start "
+             "and written on shutdown.",
+        default=None)
+
+    parser.add_argument(
+        '--cache-stats',
+        help="Filename where the cache statistics are periodically written.",
+        default=None)
+
+    parser.add_argument(
+        '--search-index',
+        help="Filename of the index of known stories that answers "
+             "requests by name before they are searched.",
+        default=None)
+
+    parser.add_argument(
+        '--record',
+        help="Record all HTTP traffic into the given archive file.",
+        default=None)
+
+    parser.add_argument(
+        '--replay',
+        help="Answer all HTTP requests from the given archive file "
+             "instead of the network.",
+        default=None)
+
     parser.add_argument(
         '-l', '--dry',
         action='store_true',
@@ -164,6 +291,14 @@ def get_bot_parameters():
         'default': args.default,
         'dry': args.dry,
         'comments': args.comments,
+        'cache': args.cache,
+        'cache_size': args.cache_size,
+        'stale_cache': args.stale_cache,
+        'cache_snapshot': args.cache_snapshot,
+        'cache_stats': args.cache_stats,
+        'search_index': args.search_index,
+        'record': args.record,
+        'replay': args.replay,
         'verbosity': args.verbosity,
         # Switches for experimental features
         'experimental': {
@@ -172,6 +307,72 @@ def get_bot_parameters():
     }
 
 
+def load_cache_snapshot():
+    """Loads the cache snapshot if there is one."""
+    try:
+        count = default_cache.load(CACHE_SNAPSHOT)
+    except FileNotFoundError:
+        logging.info("No cache snapshot found. Starting with a cold cache.")
+    except Exception:
+        logging.error("Could not load the cache snapshot.")
+        bot_tools.print_exception()
+    else:
+        logging.info("Loaded %d cache entries from %s" % (count, CACHE_SNAPSHOT))
+
+
+def save_cache_snapshot():
+    """Writes the cache snapshot."""
+    try:
+        count = default_cache.dump(CACHE_SNAPSHOT)
+    except Exception:
+        logging.error("Could not save the cache snapshot.")
+        bot_tools.print_exception()
+    else:
+        logging.info("Saved %d cache entries to %s" % (count, CACHE_SNAPSHOT))
+
+
+def load_search_index():
+    """Loads the search index if there is one."""
+    try:
+        count = default_index.load(SEARCH_INDEX)
+    except FileNotFoundError:
+        logging.info("No search index found. Starting with an empty index.")
+    except Exception:
+        logging.error("Could not load the search index.")
+        bot_tools.print_exception()
+    else:
+        logging.info("Loaded %d stories from %s" % (count, SEARCH_INDEX))
+
+
+def save_search_index():
+    """Writes the search index."""
+    try:
+        count = default_index.dump(SEARCH_INDEX)
+    except Exception:
+        logging.error("Could not save the search index.")
+        bot_tools.print_exception()
+    else:
+        logging.info("Saved %d stories to %s" % (count, SEARCH_INDEX))
+
+
+def save_snapshots(force=False):
+    """
+    Writes the cache snapshot and the search index.
+
+    Unless force is set, they are written at most once every
+    SNAPSHOT_INTERVAL seconds.
+    """
+    global LAST_SNAPSHOT
+    if not force and time.time() - LAST_SNAPSHOT < SNAPSHOT_INTERVAL:
+        return
+    LAST_SNAPSHOT = time.time()
+
+    if CACHE_SNAPSHOT is not None:
+        save_cache_snapshot()
+    if SEARCH_INDEX is not None:
+        save_search_index()
+
+
 def login_to_reddit(bot_parameters):
     """Performs the login for reddit."""
     global USER_NAME
@@ -561,6 +762,7 @@ def post_receiver(queue):
     while True:
         handler, post = queue.get()
         handler(post)
+        report_cache_statistics()
 
 
 def stream_strategy():
@@ -612,12 +814,23 @@ def single_pass():
         # of watching multiple reddits.
         subreddit = r.get_subreddit("+".join(SUBREDDIT_LIST))
 
+        submissions = list(subreddit.get_new(limit=50))
+        comments = list(subreddit.get_comments(limit=100))
+
+        # Search for all stories requested by name at once, so
+        # every distinct request is only searched once.
+        prefetch_searches(
+            [s.selftext for s in submissions
+             if not is_submission_checked(s)] +
+            [c.body for c in comments
+             if str(c.id) not in CHECKED_COMMENTS])
+
         logging.info("Parsing new submissions.")
-        for submission in subreddit.get_new(limit=50):
+        for submission in submissions:
             handle_submission(submission)
 
         logging.info("Parsing new comments.")
-        for comment in subreddit.get_comments(limit=100):
+        for comment in comments:
             handle_comment(comment)
 
         logging.info("Parsing unread messages.")
@@ -626,9 +839,45 @@ def single_pass():
 
     except Exception:
         bot_tools.print_exception()
+    report_cache_statistics()
+    save_snapshots()
     bot_tools.pause(0, 15)
 
 
+def prefetch_searches(bodies):
+    """
+    Resolves the requests by name of the given posts.
+
+    The results are cached, so answering the posts does not
+    search again.
+    """
+    queue = SearchQueue()
+    for body in bodies:
+        if "ignore" in parse_context_markers(body):
+            continue
+        for site, requests in get_requests(body):
+            for request in requests:
+                queue.add(site, request)
+
+    if len(queue):
+        logging.info("Resolving %d distinct requests." % len(queue))
+    queue.resolve()
+
+
+def report_cache_statistics():
+    """Logs the cache statistics every CACHE_STATS_INTERVAL seconds."""
+    global LAST_CACHE_STATS
+    if time.time() - LAST_CACHE_STATS < CACHE_STATS_INTERVAL:
+        return
+    LAST_CACHE_STATS = time.time()
+
+    statistics = default_cache.get_statistics()
+    logging.info("Cache statistics: " + json.dumps(statistics, sort_keys=True))
+    if bot_parameters["cache_stats"] is not None:
+        with open(bot_parameters["cache_stats"], "w") as f:
+            json.dump(statistics, f, indent=2, sort_keys=True)
+
+
 def check_submission(submission):
     """Mark the submission as checked."""
     global CHECKED_COMMENTS
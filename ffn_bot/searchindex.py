@@ -0,0 +1,211 @@
+import os
+import re
+import math
+import zlib
+import pickle
+import threading
+from collections import defaultdict
+
+
+# Minimal similarity of a request and a known story before we trust
+# the index instead of asking the search engine.
+DEFAULT_THRESHOLD = 0.8
+
+# Minimal similarity of a misspelled word of the request and a word
+# of the story.
+WORD_THRESHOLD = 0.5
+
+NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+# Numbers and roman numerals tell sequels apart, so they are never
+# allowed to be misspelled or missing. Only the roman numerals from
+# II to XX count. Single letters and "xi" are more often words.
+NUMERAL = re.compile(
+    r"^(\d+|i{2,3}|iv|vi{1,3}|ix|xi{2,3}|xiv|xvi{0,3}|xix|xx)$")
+
+# Words of a request that are not part of the title or the author.
+FILLER_WORDS = frozenset(("by",))
+
+
+def normalize(text):
+    """Lower-cases the text and strips all punctuation."""
+    return NON_WORD.sub(" ", text.lower()).strip()
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams of all words of the text.
+
+    Each word is padded so short words still produce trigrams and
+    the beginnings of words weigh more.
+    """
+    result = set()
+    for word in normalize(text).split():
+        word = "  " + word + " "
+        for i in range(len(word) - 2):
+            result.add(word[i:i + 3])
+    return frozenset(result)
+
+
+def words(text):
+    """Returns the set of words of the text."""
+    return frozenset(normalize(text).split())
+
+
+def similarity(query, grams):
+    """The dice coefficient of two trigram sets."""
+    if not query or not grams:
+        return 0.0
+    return 2.0 * len(query & grams) / (len(query) + len(grams))
+
+
+def _numerals(words):
+    return frozenset(word for word in words if NUMERAL.match(word))
+
+
+def _has_word(word, known):
+    if word in known:
+        return True
+    if NUMERAL.match(word):
+        return False
+    grams = trigrams(word)
+    return any(
+        similarity(grams, trigrams(other)) >= WORD_THRESHOLD
+        for other in known)
+
+
+def matches_words(query, title_words, author_words):
+    """
+    Checks that no word of the request is missing from the story.
+
+    Every word of the request has to be a word of the title or
+    the author, misspelled at most. Numerals have to be the same
+    on both sides, so "Story 2" never finds "Story" and the other
+    way around.
+    """
+    if _numerals(query) != _numerals(title_words):
+        return False
+    known = title_words | author_words
+    return all(
+        _has_word(word, known) for word in query - FILLER_WORDS)
+
+
+class SearchIndex(object):
+    """
+    A trigram index of all stories the bot has parsed.
+
+    Requests by name are looked up here before they are sent to the
+    search engine.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        # (site, sid) -> (url, trigrams of the title,
+        #                 trigrams of title and author,
+        #                 words of the title, words of the author)
+        self.stories = {}
+        self.postings = defaultdict(set)
+
+    def __len__(self):
+        return len(self.stories)
+
+    def add(self, key, url, title, author):
+        """
+        Adds a story to the index.
+
+        :param key:     The (site, story-id) key of the story.
+        :param url:     The link that is returned for the story.
+        :param title:   The title of the story.
+        :param author:  The author of the story.
+        """
+        title_grams = trigrams(title)
+        full_grams = title_grams | trigrams(author)
+        with self.lock:
+            self._insert(
+                key, url, title_grams, full_grams,
+                words(title), words(author))
+
+    def _insert(self, key, url, title_grams, full_grams,
+                title_words, author_words):
+        old = self.stories.get(key)
+        if old is not None:
+            # The title or the author of the story changed.
+            for gram in old[2] - full_grams:
+                self.postings[gram].discard(key)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+        self.stories[key] = (
+            url, title_grams, full_grams, title_words, author_words)
+        for gram in full_grams:
+            self.postings[gram].add(key)
+
+    def lookup(self, site, query):
+        """
+        Finds the link of the story that matches the query best.
+
+        :param site:   Only stories of this site are considered.
+        :param query:  The name of the story, optionally with its author.
+        :returns: The link or None if no story is similar enough.
+        """
+        query_words = words(query)
+        query = trigrams(query)
+        if not query:
+            return None
+
+        # A story that shares too few trigrams with the query can never
+        # reach the threshold. Such a story also has to contain one of
+        # the rarest trigrams of the query, so the long lists of common
+        # trigrams like "the" are never scanned.
+        minimum = int(math.ceil(self.threshold * len(query) / 2))
+        with self.lock:
+            postings = sorted(
+                (self.postings.get(gram, ()) for gram in query), key=len)
+            candidates = set()
+            for keys in postings[:len(query) - minimum + 1]:
+                candidates.update(keys)
+
+            best, best_score = None, self.threshold
+            for key in candidates:
+                if key[0] != site:
+                    continue
+                url, title_grams, full_grams, title_words, author_words = \
+                    self.stories[key]
+                if len(query & full_grams) < minimum:
+                    continue
+                score = max(
+                    similarity(query, title_grams),
+                    similarity(query, full_grams))
+                if score < best_score:
+                    continue
+                if matches_words(query_words, title_words, author_words):
+                    best, best_score = url, score
+            return best
+
+    def dump(self, filename):
+        """Writes the index into a file."""
+        with self.lock:
+            entries = [
+                (key,) + entry for key, entry in self.stories.items()]
+        blob = zlib.compress(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL))
+
+        # Do not destroy the last index if we crash while writing.
+        with open(filename + ".tmp", "wb") as f:
+            f.write(blob)
+        os.replace(filename + ".tmp", filename)
+        return len(entries)
+
+    def load(self, filename):
+        """Adds the stories of an index file to the index."""
+        with open(filename, "rb") as f:
+            entries = pickle.loads(zlib.decompress(f.read()))
+        # Older files do not have the words of the stories. Those
+        # stories are added again when they are loaded.
+        entries = [entry for entry in entries if len(entry) == 6]
+        with self.lock:
+            for entry in entries:
+                self._insert(*entry)
+        return len(entries)
+
+
+default_index = SearchIndex()
@@ -0,0 +1,212 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import google
+
+from ffn_bot.searchindex import default_index
+
+
+# All Google searches are sent to this host.
+GOOGLE_HOST = "http://www.google.com/"
+
+# Seconds we wait for a provider before we ask the next one as well.
+DEFAULT_DEADLINE = 5
+
+# The number of providers that may be searching at once.
+MAX_CONCURRENT_PROVIDERS = 8
+
+
+class SearchProvider(object):
+    """
+    Base-Class for a search backend that finds a story by its name.
+    """
+
+    # The name of the provider.
+    name = None
+
+    # If the provider does not find a story, it most likely does not exist.
+    authoritative = True
+
+    # The provider has to wait for the network.
+    blocking = True
+
+    def supports(self, site):
+        """Checks if the provider can find stories of the site."""
+        return True
+
+    def search(self, cache, terms, site):
+        """
+        Searches for a story.
+
+        :param cache:  The request cache that is used for all requests.
+        :param terms:  The name of the story.
+        :param site:   The site of the story.
+        :returns: The link to the story or None if it was not found.
+        :raises IOError: If the backend could not be asked.
+        """
+        return None
+
+
+class IndexProvider(SearchProvider):
+    """Finds the stories the bot has already loaded."""
+
+    name = "index"
+
+    # The index only knows the stories we have already seen.
+    authoritative = False
+    blocking = False
+
+    def __init__(self, index=default_index):
+        self.index = index
+
+    def search(self, cache, terms, site):
+        return self.index.lookup(site, terms)
+
+
+class GoogleProvider(SearchProvider):
+    """
+    Searches Google restricted to the pages of a site.
+
+    Use the url templates of the google module to send the searches
+    somewhere else.
+    """
+
+    name = "google"
+
+    # Google has not seen every story yet, and a result page without
+    # results is no proof that there is none.
+    authoritative = False
+
+    def __init__(self, host=GOOGLE_HOST):
+        self.host = host
+        self.queries = {}
+
+    def configure_site(self, site, query):
+        """
+        Allows searching stories of a site.
+
+        :param site:   The site.
+        :param query:  The query template, "%s" is replaced with the terms.
+        """
+        self.queries[site] = query
+
+    def supports(self, site):
+        return site in self.queries
+
+    def search(self, cache, terms, site):
+        # Retrying would only make Google block us for longer.
+        breaker = cache.breakers.get(self.host)
+        breaker.check()
+
+        # The limiter does the waiting for us.
+        cache.limiter.acquire(self.host)
+        try:
+            result = next(google.search(
+                self.queries[site] % terms, num=1, stop=1, pause=0), None)
+        except IOError:
+            breaker.failure()
+            raise
+        breaker.success()
+        return result
+
+
+class HedgedSearch(object):
+    """
+    Asks the search providers in order of their priority.
+
+    The next provider is asked when a provider did not find the story,
+    failed, or did not answer before the deadline. The first link that
+    is found is used. Providers that do not block are only asked by
+    lookup, all others only by search.
+    """
+
+    def __init__(self, providers=(), deadline=DEFAULT_DEADLINE,
+                 max_workers=MAX_CONCURRENT_PROVIDERS):
+        self.providers = list(providers)
+        self.deadline = deadline
+        self.pool = ThreadPoolExecutor(max_workers)
+
+    def add(self, provider):
+        """
+        Adds a provider with the lowest priority.
+
+        A provider with the same name is replaced.
+        """
+        self.providers = [
+            p for p in self.providers if p.name != provider.name]
+        self.providers.append(provider)
+
+    def get(self, name):
+        """Returns the provider with the given name."""
+        for provider in self.providers:
+            if provider.name == name:
+                return provider
+        raise KeyError(name)
+
+    def _providers(self, site, blocking):
+        return [
+            p for p in self.providers
+            if p.blocking == blocking and p.supports(site)]
+
+    def lookup(self, cache, terms, site):
+        """
+        Asks the providers that do not block, one after another.
+
+        :returns: The link or None if no provider found the story.
+        """
+        for provider in self._providers(site, False):
+            try:
+                result = provider.search(cache, terms, site)
+            except Exception as e:
+                logging.warning(
+                    "Search provider %s failed: %r" % (provider.name, e))
+                continue
+            if result is not None:
+                return result
+        return None
+
+    def search(self, cache, terms, site):
+        """
+        Searches for a story with the providers that block.
+
+        :returns: The link or None if no provider found the story.
+        :raises IOError: If every provider failed.
+        """
+        providers = iter(self._providers(site, True))
+        pending = {}
+        errors = []
+        answered = False
+
+        def ask_next():
+            provider = next(providers, None)
+            if provider is not None:
+                future = self.pool.submit(provider.search, cache, terms, site)
+                pending[future] = provider
+
+        ask_next()
+        while pending:
+            done, _ = wait(
+                pending, timeout=self.deadline, return_when=FIRST_COMPLETED)
+            if not done:
+                # The provider is too slow. Ask the next one as well.
+                ask_next()
+                continue
+
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.warning(
+                        "Search provider %s failed: %r" % (provider.name, e))
+                    errors.append(e)
+                else:
+                    if result is not None:
+                        return result
+                    answered = answered or provider.authoritative
+                ask_next()
+
+        # Only remember that there is no story if someone told us so.
+        if errors and not answered:
+            raise errors[-1]
+        return None
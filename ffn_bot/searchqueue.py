@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ffn_bot import bot_tools
+from ffn_bot.searchindex import normalize
+
+
+# The number of searches that wait for the rate limiter at once.
+MAX_CONCURRENT_SEARCHES = 4
+
+
+def _is_prefix(word):
+    return word.lower().startswith("site:") or "://" in word
+
+
+def normalize_query(query):
+    """
+    Normalizes a search query.
+
+    Trivially different spellings of a request share the same query.
+    Site restrictions and links in front of the query are only
+    lower-cased, the rest loses its case, punctuation and
+    repeated whitespace.
+    """
+    words = query.split()
+    prefix = []
+    while words and _is_prefix(words[0]):
+        prefix.append(words.pop(0).lower())
+
+    rest = normalize(" ".join(words))
+    if rest:
+        prefix.append(rest)
+    return " ".join(prefix)
+
+
+class SearchQueue(object):
+    """
+    Collects the requests by name of a polling pass and resolves
+    every distinct request once.
+
+    The results are stored in the cache where the comments pick
+    them up when they are answered.
+    """
+
+    def __init__(self):
+        self.requests = OrderedDict()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, site, request):
+        """
+        Queues a request.
+
+        :param site:     The site the request was sent to.
+        :param request:  The request as written in the comment.
+        """
+        key = (site.name, normalize_query(request))
+        self.requests.setdefault(key, (site, request))
+
+    def resolve(self, max_workers=MAX_CONCURRENT_SEARCHES):
+        """Resolves all queued requests and empties the queue."""
+        if not self.requests:
+            return
+        with ThreadPoolExecutor(max_workers) as pool:
+            list(pool.map(self._resolve, self.requests.values()))
+        self.requests.clear()
+
+    @staticmethod
+    def _resolve(job):
+        site, request = job
+        try:
+            site.find_link(request, set())
+        except Exception:
+            bot_tools.print_exception()
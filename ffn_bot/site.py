@@ -1,16 +1,72 @@
 import re
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import logging
 
+from lxml import html
+
 from ffn_bot import reddit_markdown
+from ffn_bot.cache import default_cache, PageNotFound
+from ffn_bot.searchindex import default_index
 
 WHITESPACE = re.compile("(|[ ]+(?!\Z))")
 
 
+# The extracted fields of a story that will be cached instead of
+# the parsed page.
+StoryRecord = namedtuple(
+    "StoryRecord", "title author authorlink summary stats download")
+
+
 class StoryDoesNotExist(Exception):
     pass
 
 
+def _plain(value):
+    """
+    Converts the strings of a value into plain strings.
+
+    Strings returned by lxml keep their whole document alive.
+    """
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, dict):
+        return OrderedDict(
+            (_plain(k), _plain(v)) for k, v in value.items())
+    if isinstance(value, (tuple, list)):
+        return type(value)(_plain(item) for item in value)
+    return value
+
+
+def parse_region(page, start=None, end=None):
+    """
+    Parses only the part of a page between two markers.
+
+    The region begins with the tag containing the start marker and
+    ends before the tag containing the end marker. If a marker is
+    missing, the region extends to that end of the page.
+
+    :param page:   The page.
+    :param start:  A compiled regular expression or None.
+    :param end:    A compiled regular expression or None.
+    :returns: The parsed region.
+    """
+    begin = 0
+    if start is not None:
+        match = start.search(page)
+        if match is not None:
+            begin = max(page.rfind("<", 0, match.start()), 0)
+
+    stop = len(page)
+    if end is not None:
+        match = end.search(page, begin)
+        if match is not None:
+            stop = page.rfind("<", begin, match.start())
+            if stop < 0:
+                stop = match.start()
+
+    return html.fromstring(page[begin:stop])
+
+
 class Site(object):
     """
     Base-Class for a supported fanfiction archive.
@@ -47,6 +103,16 @@ class Site(object):
         """
         return ()
 
+    def find_link(self, request, context):
+        """
+        Returns the link to the story the request refers to.
+
+        :param request:  A single request.
+        :param context:  The comment context.
+        :returns: The link or None if the story cannot be found.
+        """
+        return None
+
     def from_requests(self, requests, context):
         """
         Returns an iterable of story objects that are assiciated with this
@@ -62,9 +128,18 @@ class Story(object):
     Represents a single story.
     """
 
+    # Everything after this marker of a story page is not needed.
+    # Pages are only downloaded up to it.
+    STOP_MARKER = None
+
+    # Only the part of a story page between these markers is parsed.
+    REGION_START = None
+    REGION_END = None
+
     def __init__(self, context=None):
         self.context = set() if context is None else context
         self._loaded = False
+        self.download = None
 
     def get_title(self):
         """Returns the title of the story"""
@@ -76,7 +151,7 @@ class Story(object):
 
     def get_download(self):
         """Return the EPUB and MOBI download link for a fic."""
-        return None
+        return self.download
 
     def get_summary(self):
         """Returns the summary of the story."""
@@ -94,6 +169,14 @@ class Story(object):
         """Returns the link to the story."""
         return self.url
 
+    def get_key(self):
+        """
+        Returns the canonical (site, story-id) tuple of the story.
+
+        All links to the same story share the same key.
+        """
+        return self.key
+
     def get_stats(self):
         """Returns the stats to the story."""
         return self.stats
@@ -173,21 +256,69 @@ class Story(object):
         return string
 
     def __hash__(self):
-        # We will use the URL for a hash.
-        try:
-            return hash(self.get_url())
-        except:
-            return 0
+        return hash(self.get_key())
 
     def __eq__(self, other):
         if not isinstance(other, Story):
             return False
-        return other.get_url() == self.get_url()
+        return other.get_key() == self.get_key()
+
+    def get_record(self):
+        """Returns the extracted fields of the story."""
+        return StoryRecord(*(_plain(field) for field in (
+            self.get_title(), self.get_author(), self.get_author_link(),
+            self.get_summary(), self.get_stats(), self.get_download())))
+
+    def set_record(self, record):
+        """Restores the fields of the story from a record."""
+        (self.title, self.author, self.authorlink,
+         self.summary, self.stats, self.download) = record
 
     def load(self):
-        if not self._loaded:
-            self.parse_html()
+        if self._loaded:
+            return
+
+        # Repeated requests for a story only cost a lookup.
+        key = "%s/%s" % self.get_key()
+        try:
+            self.set_record(default_cache.hit_cache("story", key))
+        except KeyError:
+            self._parse_and_cache(key)
         self._loaded = True
 
+        # Later requests for the story by name are answered locally.
+        if self.get_title():
+            default_index.add(
+                self.get_key(), self.get_url(),
+                self.get_title(), self.get_author())
+
+    def _parse_and_cache(self, key):
+        if default_cache.hit_miss("story", key):
+            raise StoryDoesNotExist(self.get_url())
+
+        default_cache.track_pages()
+        try:
+            self.parse_html()
+        except PageNotFound:
+            default_cache.push_miss("story", key)
+            raise
+        except IOError:
+            # Network errors say nothing about the story.
+            raise
+        except Exception:
+            # The page does not contain a story we can parse.
+            default_cache.push_miss("story", key)
+            raise
+        finally:
+            page_time = default_cache.page_time()
+
+        # A record parsed from a stale page expires with the page.
+        default_cache.push_cache(
+            "story", key, self.get_record(), t=page_time)
+
+    def parse_page(self, page):
+        """Parses the region of the page that contains the story data."""
+        return parse_region(page, self.REGION_START, self.REGION_END)
+
     def parse_html(self):
         pass
@@ -33,19 +33,27 @@ __all__ = ['search']
 import os
 import sys
 import time
+import atexit
+import threading
+
+import requests
+from lxml import etree, html as lxml_html
 
 if sys.version_info[0] > 2:
     from http.cookiejar import LWPCookieJar
-    from urllib.request import Request, urlopen
     from urllib.parse import quote_plus, urlparse, parse_qs
 else:
     from cookielib import LWPCookieJar
     from urllib import quote_plus
-    from urllib2 import Request, urlopen
     from urlparse import urlparse, parse_qs
 
-# Lazy import of BeautifulSoup.
-BeautifulSoup = None
+# Precompiled queries on the result pages.
+xpath_anchors = etree.XPath('//*[@id="search"]//a')
+xpath_has_nav = etree.XPath('boolean(//*[@id="nav"])')
+# Result pages, even those without results, have one of these.
+# CAPTCHA and block pages have none.
+xpath_has_results = etree.XPath(
+    'boolean(//*[@id="search" or @id="res" or @id="topstuff"])')
 
 # URL templates to make Google searches.
 url_home = "http://www.google.%(tld)s/"
@@ -64,6 +72,55 @@ try:
 except Exception:
     pass
 
+# Seconds between two writes of the cookie jar.
+cookie_save_interval = 5 * 60
+cookie_lock = threading.Lock()
+last_cookie_save = time.time()
+
+# Keep-alive session that is used for all requests.
+session = requests.Session()
+session.cookies = cookie_jar
+session.headers['User-Agent'] = \
+    'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0)'
+
+# Timeout of a request in seconds.
+timeout = 10
+
+# Fetch the home page before every search, even if we have a cookie.
+# Recorded traffic then does not depend on the local cookie jar.
+always_fetch_home = False
+
+
+def save_cookies(force=False):
+    """
+    Write the cookie jar to disk.
+
+    Unless C{force} is set, the jar is written at most once every
+    C{cookie_save_interval} seconds.
+    """
+    global last_cookie_save
+    with cookie_lock:
+        if not force and time.time() - last_cookie_save < cookie_save_interval:
+            return
+        last_cookie_save = time.time()
+        try:
+            cookie_jar.save()
+        except Exception:
+            pass
+
+atexit.register(save_cookies, True)
+
+
+def has_cookie(tld='com'):
+    """
+    Check if we still have an unexpired cookie from the Google home page.
+    """
+    domain = 'google.' + tld
+    for cookie in cookie_jar:
+        if cookie.domain.lstrip('.').endswith(domain) and not cookie.is_expired():
+            return True
+    return False
+
 
 # Request the given URL and return the response page, using the cookie jar.
 def get_page(url):
@@ -77,18 +134,13 @@ def get_page(url):
     @return: Web page retrieved for the given URL.
 
     @raise IOError: An exception is raised on error.
-    @raise urllib2.URLError: An exception is raised on error.
-    @raise urllib2.HTTPError: An exception is raised on error.
+    @raise requests.ConnectionError: An exception is raised on error.
+    @raise requests.HTTPError: An exception is raised on error.
     """
-    request = Request(url)
-    request.add_header('User-Agent',
-                       'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0)')
-    cookie_jar.add_cookie_header(request)
-    response = urlopen(request)
-    cookie_jar.extract_cookies(response, request)
-    html = response.read()
-    response.close()
-    cookie_jar.save()
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    html = response.content
+    save_cookies()
     return html
 
 
@@ -213,15 +265,6 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
         parameter is C{None} the iterator will loop forever.
     """
 
-    # Lazy import of BeautifulSoup.
-    # Try to use BeautifulSoup 4 if available, fall back to 3 otherwise.
-    global BeautifulSoup
-    if BeautifulSoup is None:
-        try:
-            from bs4 import BeautifulSoup
-        except ImportError:
-            from BeautifulSoup import BeautifulSoup
-
     # Set of hashes for the results found.
     # This is used to avoid repeated results.
     hashes = set()
@@ -238,8 +281,9 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
                 builtin_param
             )
 
-    # Grab the cookie from the home page.
-    get_page(url_home % vars())
+    # Grab the cookie from the home page, unless we still have it.
+    if always_fetch_home or not has_cookie(tld):
+        get_page(url_home % vars())
 
     # Prepare the URL of the first request.
     if start:
@@ -271,20 +315,22 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
         html = get_page(url)
 
         # Parse the response and process every anchored URL.
-        soup = BeautifulSoup(html)
-        anchors = soup.find(id='search').findAll('a')
-        for a in anchors:
+        tree = lxml_html.fromstring(html)
+        if not xpath_has_results(tree):
+            raise IOError(
+                "Google did not send a result page, we are probably blocked")
+        for a in xpath_anchors(tree):
 
             # Leave only the "standard" results if requested.
             # Otherwise grab all possible links.
-            if only_standard and (
-                    not a.parent or a.parent.name.lower() != "h3"):
-                continue
+            if only_standard:
+                parent = a.getparent()
+                if parent is None or parent.tag.lower() != "h3":
+                    continue
 
             # Get the URL from the anchor tag.
-            try:
-                link = a['href']
-            except KeyError:
+            link = a.get('href')
+            if link is None:
                 continue
 
             # Filter invalid links and links pointing to Google itself.
@@ -302,7 +348,7 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
             yield link
 
         # End if there are no more results.
-        if not soup.find(id='nav'):
+        if not xpath_has_nav(tree):
             break
 
         # Prepare the URL for the next request.